@@ -1,63 +1,422 @@
 # Code snippet to generate the pre-processed csv files
-# Run as: python Step1B-Generate-data-csv.py path-to-text-files
+# Run as: python Step1B-Generate-data-csv.py path-to-text-files [--workers N] [--chunk-size MB] [--partition-by patid|year] [--compress gzip|zstd] [--format parquet [--partition-by pracid|year]] [--typed-ids] [--engine arrow] [--progress SECONDS] [--profile TABLE]
 # User gives the directory path which contains (only) the cprd txt files to process
+# The txt files can also be read compressed, without unpacking them first: as .txt.gz or .txt.zst files, or from the .zip archives
+# they were delivered in; they are decompressed by a separate thread while the rows are converted (a compressed file cannot be
+# split into chunks, so it is converted by a single worker)
 # The csv files are outputted into a new 'data_csv' sub-directory and used for Step1C
+# A 'manifest.json' in that directory records the size, mtime and content hash of each txt file and how far its conversion got:
+# re-running into the same directory only converts new or changed files, and resumes an interrupted run from the last completed chunk
+# Each txt file is streamed through in batches of 'batch_size' rows, so memory use stays flat whatever the size of the file
+# The rows are converted from the Step1A metadata types of their table (path-to-text-files/metadata_csv by default): DATE fields
+# from DD/MM/YYYY to YYYY-MM-DD, NUMERIC/DECIMAL fields stripped of padding, blank cells of both emptied (NULL), the other columns
+# copied as they are; a table without metadata has its date columns found from their names ('date' in the name, or 'lcd')
+# With --engine arrow (needs the pyarrow library), each file is memory-mapped and read and converted in columns by pyarrow instead
+# of row by row with the csv module, which is several times faster; the csv files hold the same values (a batch with a value
+# that needs quotes has all its values quoted), and a file that pyarrow cannot read is converted by rows (the patid/year
+# pre-split of the csv files is always done by rows)
+# With --workers N, files are converted concurrently by N processes, and files bigger than --chunk-size are split into
+# byte ranges that are converted in parallel and stitched back together in order (so the output is the same as with 1 worker)
+# With --format parquet, each table is written as a parquet dataset directory in a 'data_parquet' sub-directory instead, with
+# column types from the Step1A metadata (TEXT as string, DATE as date32, NUMERIC/DECIMAL as decimal, INTEGER as int32)
+# With --partition-by patid or year (csv only), the Observation and DrugIssue files are pre-split to match the partitions of
+# the tables created by Step1C/Step1D with the same options: one csv file per patid hash partition, cut with PostgreSQL's own
+# partition hash (e.g. Observation_001__p03.csv), or per year of the event date (e.g. Observation_001__y2015.csv)
+# With --typed-ids, the numeric identifiers (patid, obsid, medcodeid, prodcodeid, ...) are checked as they are converted, so that
+# Step1C/Step1D/Step1E can store them as BIGINT (int64 in parquet): a file with a value that would not read back unchanged
+# (not only digits, a leading zero, more than 2**63-1) is reported and not recorded as done
+# With --compress gzip or zstd (csv only), the csv files are written compressed (.csv.gz or .csv.zst, zstd needs the zstandard
+# library), which Step1C, Step1E and the cohort extraction read as they are
+# Each chunk records its rows, bytes read and written, the seconds spent reading, parsing, converting and writing its batches,
+# and the peak memory of its process; progress lines with an ETA are printed every --progress seconds, and the figures per
+# chunk, file and table are written to a json run report ('run_report.json' in the output directory, or --report), unless
+# the run had nothing to convert
+# With --profile TABLE, the chunks of that table are converted in the main process under cProfile (the stats are written to
+# profile-TABLE.prof in the output directory), where py-spy can also attach to them
 # (Example) list_of_filenames = ['Common_Dosages','ConsSource','Consultation','DrugIssue','EMISCodeCat','Gender','JobCat','MedicalDictionary','NumUnit','Observation','ObsType','OrgType','ParentProbRel','Patient','PatientType','Practice','Problem','ProbStatus','ProductDictionary','QuantUnit','Referral','RefMode','RefServiceType','RefUrgency','Region','Sign','Staff']
 
 ## Libraries
 import os
-import sys
-import datetime
+import argparse
 import csv
-import numpy as np
-
-## Inputs and directories 
-path_from = sys.argv[1]
-path_to = path_from + '/data_csv'
-
-## ! don't change code below
-
-list_of_filenames_ext = os.listdir(path_from)
-list_of_filenames=[x.split('.')[0] for x in list_of_filenames_ext] # this assume no period (.) in the filename
-
-# create 'path_to'
-if os.path.isdir(path_to):
-   print('There is already a csv directory. Exiting!')
-   exit()
-else:
-   os.mkdir(path_to)
-
-# loop over txt files
-for name in list_of_filenames:
-    print('reading:',name)
-    # read file into variable r
-    r = csv.reader(open(path_from + '/' + name + '.txt', 'r', encoding='latin1'), delimiter='	',quotechar='"')
-    
-    #list to store data in and appending values
-    data=[]
-    for row in r: 
-        #print(row)
-        data.append(row)
-      
-    #separating header of file to extract fields == 'lcd' OR that contain 'date' as substring (can tweak later to avoid hardcoding)      
-    header = data[0]
-    print('header:',header)
-    date_fields = [idx for idx, x in enumerate(header) if ('date' in x) or (x == 'lcd')]         
-    
-    #looping over all rows i and cols j of list
-    for i, row in enumerate(data): # loop rows
-        for j, col in enumerate(row): # loop cols in rows
-            #print('row:',i,'col:',j,col)
-            
-            #condition to filter datetime fields and reformat from dd/mm/yyyy to datetime format (YYYY-MM-DDT00:00:00.000)
-            if (len(col)>6) & (j in date_fields) & (i != 0):
-                data[i][j] = datetime.datetime.strptime(col, "%d/%m/%Y").strftime("%Y-%m-%d")
-                #print('new col:',j,data[i][j])
-                
-    # open/create the file to write comma separated values to
-    with open(path_to + '/' + name + '.csv', 'w') as new_csv_file:
+import shutil
+import glob
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import aurum_utils
+
+## Functions
+def rows_fallback(stats, error):
+    # new ChunkStats to convert a chunk again with the rows engine, once pyarrow could not split it into columns
+    print('  ' + stats.name, 'chunk', stats.chunk, 'is converted by rows, pyarrow could not read it:', str(error).splitlines()[0])
+    return aurum_utils.ChunkStats(stats.name, stats.chunk, stats.bytes_read, stats.compressed, stats.progress_seconds)
+
+def convert_chunk(txt_path, out_path, header, start, end, batch_size, write_header, fields, csv_ext, engine, stats):
+    # converts the rows of txt_path starting within [start, end) and writes them as csv to out_path
+    # (compressed if csv_ext is .csv.gz or .csv.zst; the part file of a chunk is compressed on its own)
+    # with engine 'arrow', the rows are read and converted in columns, in blocks of 1 MB (aurum_utils.arrow_batches);
+    # a chunk that pyarrow cannot read (e.g. a row with more or fewer columns than the header) is converted again by rows
+    # returns stats (aurum_utils.ChunkStats), filled in with the rows, bytes and seconds per stage of the chunk
+    if engine == 'arrow':
+        import pyarrow as pa
+        try:
+            with aurum_utils.open_csv(out_path, 'w', csv_ext) as new_csv_file:
+                if write_header:
+                    csv.writer(new_csv_file, delimiter=',').writerow(header)
+                new_csv_file.flush() # the batches are written as bytes, below the text layer
+                for batch in aurum_utils.arrow_batches(txt_path, header, start, end, fields, stats):
+                    new_csv_file.buffer.write(aurum_utils.csv_bytes(batch))
+            stats.done()
+            stats.bytes_written = os.path.getsize(out_path)
+            return stats
+        except pa.ArrowInvalid as error:
+            stats = rows_fallback(stats, error)
+    with aurum_utils.open_csv(out_path, 'w', csv_ext) as new_csv_file:
         csv_writer = csv.writer(new_csv_file, delimiter=',')
-        for rows in data:
-            csv_writer.writerow(rows)
-        
-        print('Exported file',name,'.csv to location:', path_to)
+        if write_header:
+            csv_writer.writerow(header)
+        #only 'batch_size' rows are held in memory, with the datetime fields reformatted from dd/mm/yyyy to YYYY-MM-DD
+        for data in aurum_utils.converted_batches(txt_path, header, start, end, batch_size, fields, stats):
+            csv_writer.writerows(data)
+    stats.done()
+    stats.bytes_written = os.path.getsize(out_path)
+    return stats
+
+def convert_chunk_parquet(txt_path, out_dir, header, start, end, batch_size, fields, partition_by, basename, engine, stats):
+    # converts the rows of txt_path starting within [start, end) and writes them as parquet files named basename-*.parquet
+    # into the dataset directory out_dir, typed from the metadata fields and optionally partitioned ('pracid' or 'year')
+    # with engine 'arrow', the columns from aurum_utils.arrow_batches are cast to their types, as in convert_chunk
+    # returns stats, as convert_chunk (the conversion of the rows to arrow counts as writing)
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    schema = aurum_utils.arrow_schema(header, fields)
+    date_field = aurum_utils.event_date_field(fields)
+    if partition_by == 'year' and date_field in schema.names:
+        out_schema = schema.append(pa.field('year', pa.int16()))
+    elif partition_by == 'pracid' and 'pracid' in schema.names:
+        out_schema = schema
+    else: # this table has no column to partition on
+        out_schema, partition_by = schema, None
+
+    def batches(engine):
+        if engine == 'arrow':
+            converted = (aurum_utils.typed_batch(batch, schema) for batch in aurum_utils.arrow_batches(txt_path, header, start, end, fields, stats))
+        else:
+            converted = (aurum_utils.record_batch(data, schema) for data in aurum_utils.converted_batches(txt_path, header, start, end, batch_size, fields, stats))
+        for batch in converted:
+            if partition_by == 'year':
+                batch = aurum_utils.with_year_column(batch, date_field)
+            yield batch
+
+    def write(engine):
+        ds.write_dataset(batches(engine), out_dir, schema=out_schema, format='parquet',
+                         partitioning=[partition_by] if partition_by else None, partitioning_flavor='hive',
+                         basename_template=basename + '-{i}.parquet', existing_data_behavior='overwrite_or_ignore',
+                         max_partitions=1000000)
+    try:
+        write(engine)
+    except pa.ArrowInvalid as error:
+        if engine != 'arrow':
+            raise
+        for path in glob.glob(out_dir + '/**/' + glob.escape(basename) + '-*.parquet', recursive=True):
+            os.remove(path)
+        stats = rows_fallback(stats, error)
+        write('rows')
+    stats.done()
+    stats.bytes_written = sum(os.path.getsize(path) for path in glob.glob(out_dir + '/**/' + glob.escape(basename) + '-*.parquet', recursive=True))
+    return stats
+
+def convert_chunk_split(txt_path, path_to, name, header, start, end, batch_size, partitioning, key_field, part, fields, csv_ext, stats):
+    # as convert_chunk, but splits the rows between one csv file per partition, named name__<suffix>.csv (or csv_ext)
+    # (for a chunk of a big file, part is the chunk number and the rows are written without header to name__<suffix>.csv.partNNNNN)
+    # returns stats, as convert_chunk
+    key = header.index(key_field)
+    bigint = (aurum_utils.find_field(fields, key_field) or {}).get('Type') == 'BIGINT' # patid hashed as the table will store it
+    out_paths, csv_files, csv_writers = {}, {}, {}
+    try:
+        for data in aurum_utils.converted_batches(txt_path, header, start, end, batch_size, fields, stats):
+            rows_per_suffix = {}
+            for row in data:
+                rows_per_suffix.setdefault(partitioning.suffix_of(row[key], bigint), []).append(row)
+            for suffix, rows in rows_per_suffix.items():
+                if suffix not in csv_writers:
+                    out_paths[suffix] = path_to + '/' + name + '__' + suffix + csv_ext + ('' if part is None else '.part' + str(part).zfill(5))
+                    csv_files[suffix] = aurum_utils.open_csv(out_paths[suffix], 'w', csv_ext)
+                    csv_writers[suffix] = csv.writer(csv_files[suffix], delimiter=',')
+                    if part is None:
+                        csv_writers[suffix].writerow(header)
+                csv_writers[suffix].writerows(rows)
+    finally:
+        for csv_file in csv_files.values():
+            csv_file.close()
+    stats.done()
+    stats.bytes_written = sum(os.path.getsize(out_path) for out_path in out_paths.values())
+    return stats
+
+def stitch_chunks(out_path, header, part_paths):
+    # writes the header then appends the converted chunks in order
+    # (compressed: the header and each chunk are separate gzip members or zstd frames, which read back as one file)
+    # the chunks are only removed once the file is complete, so an interrupted stitch can simply be redone
+    with aurum_utils.open_csv(out_path, 'w') as new_csv_file:
+        csv.writer(new_csv_file, delimiter=',').writerow(header)
+    with open(out_path, 'ab') as new_csv_file:
+        for part_path in part_paths:
+            with open(part_path, 'rb') as part_file:
+                shutil.copyfileobj(part_file, new_csv_file, 16 * 1024 * 1024)
+    for part_path in part_paths:
+        os.remove(part_path)
+
+def stitch_split_chunks(path_to, name, header, csv_ext):
+    # stitches the chunks of each partition file of a pre-split txt file (not every chunk has rows in every partition)
+    part_paths = {}
+    for part_path in sorted(glob.glob(path_to + '/' + glob.escape(name) + '__*' + csv_ext + '.part*')):
+        part_paths.setdefault(part_path[:-len('.part00000')], []).append(part_path)
+    for out_path, paths in part_paths.items():
+        stitch_chunks(out_path, header, paths)
+
+def remove_outputs(path_to, name, output_format, chunk=None, csv_ext='.csv'):
+    # removes what was written from txt file 'name' by a previous run (or only from one of its chunks)
+    if output_format == 'csv':
+        paths = [path_to + '/' + name + csv_ext] + glob.glob(path_to + '/' + glob.escape(name) + '__*' + csv_ext) if chunk is None else []
+        for pattern in [glob.escape(name), glob.escape(name) + '__*']:
+            paths += glob.glob(path_to + '/' + pattern + csv_ext + '.part' + ('*' if chunk is None else str(chunk).zfill(5)))
+    else:
+        table_dir = path_to + '/' + aurum_utils.table_name(name)
+        basename = glob.escape(name) + '-' + ('*' if chunk is None else str(chunk).zfill(5) + '-*') + '.parquet'
+        paths = glob.glob(table_dir + '/**/' + basename, recursive=True)
+    for path in paths:
+        if os.path.isfile(path):
+            os.remove(path)
+
+def print_rate(label, n_rows, elapsed):
+    print(label, '| rows:', n_rows, '| seconds:', round(elapsed, 2), '| rows/sec:', round(n_rows / elapsed) if elapsed > 0 else n_rows)
+
+
+if __name__ == '__main__':
+    ## Inputs and directories
+    parser = argparse.ArgumentParser(description='Convert CPRD Aurum txt files to csv (or parquet) files for Step1C')
+    parser.add_argument('path_from', help='directory containing the cprd txt files')
+    parser.add_argument('--workers', type=int, default=1, help='number of processes converting files/chunks concurrently (default: 1)')
+    parser.add_argument('--chunk-size', type=int, default=512, help='files bigger than this many MB are split into chunks of this size when --workers > 1 (default: 512)')
+    parser.add_argument('--batch-size', type=int, default=100000, help='number of rows held in memory at any one time, per worker (default: 100000)')
+    parser.add_argument('--format', choices=['csv', 'parquet'], default='csv', help='output format (default: csv); parquet needs the pyarrow library')
+    parser.add_argument('--partition-by', choices=['pracid', 'patid', 'year'], help='csv: pre-split Observation and DrugIssue into patid shards or years of the event date; parquet: partition each table on pracid, or on the year of its event date')
+    parser.add_argument('--partitions', type=int, default=16, help='csv with --partition-by patid: number of patid hash partitions (default: 16)')
+    parser.add_argument('--years', default='1990-2022', help='csv with --partition-by year: first and last year with their own file, earlier and later years go to the __ybefore and __default files (default: 1990-2022)')
+    parser.add_argument('--metadata-path', help='directory of the Step1A metadata csv files, to convert and type the columns and find the event date (default: path_from/metadata_csv)')
+    parser.add_argument('--metadata-version', default='v2p9', help='version suffix of the metadata csv files (default: v2p9)')
+    parser.add_argument('--typed-ids', action='store_true', help='check that the numeric identifiers can be stored as BIGINT (and write them as int64 in parquet)')
+    parser.add_argument('--compress', choices=['gzip', 'zstd'], help='write the csv files compressed, as .csv.gz or .csv.zst (zstd needs the zstandard library)')
+    parser.add_argument('--engine', choices=['rows', 'arrow'], default='rows', help='rows: read the txt files with the csv module, row by row; arrow: memory-map them and read and convert them in columns with pyarrow (not used with --partition-by patid/year in csv) (default: rows)')
+    parser.add_argument('--progress', type=int, default=30, help='print the progress of the run, and of each chunk being converted, every this many seconds; 0 for none (default: 30)')
+    parser.add_argument('--report', help='json file to write the run report to (default: run_report.json in the output directory)')
+    parser.add_argument('--profile', metavar='TABLE', help='convert the files of this table (e.g. Observation) in the main process under cProfile, and write the stats to profile-TABLE.prof in the output directory')
+    args = parser.parse_args()
+    if args.format == 'csv' and args.partition_by == 'pracid':
+        parser.error('--partition-by pracid is for --format parquet only')
+    if args.format == 'parquet' and args.partition_by == 'patid':
+        parser.error('--partition-by patid is for --format csv only')
+    if args.format == 'parquet' and args.compress:
+        parser.error('--compress is for --format csv only (parquet files are compressed with snappy)')
+
+    path_from = args.path_from
+    path_to = path_from + '/data_' + args.format
+    metadata_path = args.metadata_path or path_from + '/metadata_csv'
+    typed_ids = args.typed_ids
+    csv_ext = aurum_utils.CSV_EXTENSIONS[args.compress]
+    batch_size = args.batch_size
+    chunk_bytes = args.chunk_size * 1024 * 1024
+    partitioning = aurum_utils.parse_partitioning(args.partition_by, args.partitions, args.years) if args.format == 'csv' else None
+
+    ## ! don't change code below
+
+    txt_paths = aurum_utils.txt_sources(path_from) # {name: path of its txt file, plain or compressed, or archive.zip::member}
+    list_of_filenames = sorted(txt_paths)
+
+    # create 'path_to', or pick up where the last run into it stopped
+    # the manifest records each converted txt file, so only new or changed files (or unfinished chunks) are converted
+    os.makedirs(path_to, exist_ok=True)
+    manifest = aurum_utils.Manifest(path_to + '/manifest.json')
+    options = {'partition_by': args.partition_by}
+    if partitioning:
+        options['partitioning'] = partitioning.options()
+    if typed_ids:
+        options['typed_ids'] = True
+    if args.compress:
+        options['compress'] = args.compress
+    if manifest.files and manifest.options != options:
+        print('The existing', path_to, 'directory was written with different options', manifest.options, '- use these options or a new directory. Exiting!')
+        exit()
+    manifest.options = options
+    for name in sorted(set(manifest.files) - set(list_of_filenames)):
+        print('not in', path_from, 'anymore, its output is left as is:', name)
+
+    pool = ProcessPoolExecutor(max_workers=args.workers) if args.workers > 1 else None
+
+    # content hash of the txt files, only recomputed for files whose size or mtime differs from the manifest
+    to_hash = [name for name in list_of_filenames if not manifest.is_unchanged(name, txt_paths[name])]
+    print('hashing', len(to_hash), 'new or modified files')
+    hashes = dict(zip(to_hash, (pool.map if pool else map)(aurum_utils.file_sha256, [txt_paths[name] for name in to_hash])))
+
+    # split each txt file into tasks: a single task for the whole file, or byte-range chunks of a big file when running in parallel
+    # tasks of the biggest files are listed first so that they do not hold up the end of the run
+    tasks = []
+    table_fields = {}
+    file_parts = {}
+    to_finish = []
+    for name in sorted(list_of_filenames, key=lambda x: -aurum_utils.source_stat(txt_paths[x])[0]):
+        txt_path = txt_paths[name]
+        sha256 = hashes[name] if name in hashes else manifest.files[name]['sha256']
+        status = manifest.check(name, txt_path, sha256)
+        if status == 'done':
+            print('unchanged, skipping:', name)
+            continue
+        header, data_start = aurum_utils.read_header(txt_path)
+        if status == 'new':
+            print('reading:',name)
+            print('header:',header)
+            remove_outputs(path_to, name, args.format, csv_ext=csv_ext)
+            manifest.start(name, txt_path, sha256, aurum_utils.txt_byte_ranges(txt_path, data_start, chunk_bytes if args.workers > 1 else 0))
+        entry = manifest.files[name]
+        byte_ranges = entry['byte_ranges']
+        if status == 'resume':
+            print('resuming:', name, '(' + str(len(entry['chunks_done'])), 'of', len(byte_ranges), 'chunks already done)')
+        # the metadata of each table is read once: the rows are converted from its types (dates, numbers), and so are the
+        # parquet columns typed and the identifiers checked with --typed-ids
+        # (parquet: one dataset directory per table, the part files of a table and their chunks all write into it)
+        table = aurum_utils.table_name(name)
+        if table not in table_fields:
+            try:
+                table_fields[table] = aurum_utils.read_metadata(metadata_path, table, args.metadata_version)
+            except FileNotFoundError as error:
+                print(error, '- the date columns of', table, 'are found from their names, and all its columns are written as strings')
+                table_fields[table] = []
+            if typed_ids:
+                table_fields[table] = aurum_utils.typed_id_fields(table_fields[table])
+        fields = table_fields[table]
+        key_field = None
+        if partitioning and partitioning.applies_to(name):
+            if fields:
+                key_field = partitioning.key_field(fields)
+            else: # the patid split does not need the metadata
+                key_field = 'patid' if partitioning.by == 'patid' else None
+            if key_field not in header:
+                print('no', args.partition_by, 'field found, not splitting:', name)
+                key_field = None
+        if args.format == 'csv' and len(byte_ranges) > 1:
+            file_parts[name] = (header, [path_to + '/' + name + csv_ext + '.part' + str(k).zfill(5) for k in range(len(byte_ranges))], key_field)
+
+        pending = [k for k in range(len(byte_ranges)) if k not in entry['chunks_done']]
+        if not pending: # all chunks were converted but the run stopped before the file was completed
+            to_finish.append(name)
+        for k in pending:
+            start, end = byte_ranges[k]
+            stats = aurum_utils.ChunkStats(name, k, end - start, aurum_utils.is_compressed(txt_path), args.progress)
+            if args.format == 'parquet':
+                remove_outputs(path_to, name, args.format, k) # anything left by an interrupted run of this chunk
+                tasks.append((name, k, convert_chunk_parquet, (txt_path, path_to + '/' + table, header, start, end, batch_size, fields, args.partition_by, name + '-' + str(k).zfill(5), args.engine, stats)))
+            elif key_field:
+                tasks.append((name, k, convert_chunk_split, (txt_path, path_to, name, header, start, end, batch_size, partitioning, key_field, k if name in file_parts else None, fields, csv_ext, stats)))
+            elif name in file_parts:
+                tasks.append((name, k, convert_chunk, (txt_path, file_parts[name][1][k], header, start, end, batch_size, False, fields, csv_ext, args.engine, stats)))
+            else:
+                tasks.append((name, k, convert_chunk, (txt_path, path_to + '/' + name + csv_ext, header, start, end, batch_size, True, fields, csv_ext, args.engine, stats)))
+    manifest.save()
+
+    # convert, one file after another with 1 worker, else across a pool of processes
+    # (with --profile, the tasks of that table run in this process, while the pool works on the others)
+    # (the last argument of each task is its ChunkStats)
+    run_start = time.perf_counter()
+    rows_converted = 0
+    run_report = aurum_utils.RunReport(args.report or path_to + '/run_report.json', sum(task[3][-1].bytes_read for task in tasks),
+                                       dict(vars(args), options=options), args.progress)
+    profiled = [task for task in tasks if args.profile and aurum_utils.table_name(task[0]).lower() == args.profile.lower()]
+    tasks = [task for task in tasks if task not in profiled]
+    if args.profile and not profiled:
+        print('nothing to convert for --profile', args.profile)
+
+    file_rows, file_seconds = {}, {}
+    def file_done(name):
+        if name in file_parts and file_parts[name][2]:
+            stitch_split_chunks(path_to, name, file_parts[name][0], csv_ext)
+        elif name in file_parts:
+            stitch_chunks(path_to + '/' + name + csv_ext, *file_parts[name][:2])
+        manifest.file_done(name)
+        print('Exported file',name,'.' + args.format,'to location:', path_to)
+        # the rate of a file is from the seconds of its own chunks in this run (summed over the workers that converted them),
+        # not from the start of the run; a file only stitched from the chunks of an earlier run has none
+        if name in file_seconds:
+            print_rate(name, file_rows[name], file_seconds[name])
+
+    def task_done(name, k, stats):
+        # the manifest is saved after every chunk, so that an interrupted run resumes from the last completed chunk
+        global rows_converted
+        rows_converted += stats.rows
+        file_rows[name] = file_rows.get(name, 0) + stats.rows
+        file_seconds[name] = file_seconds.get(name, 0) + stats.seconds
+        run_report.chunk_done(stats)
+        if manifest.chunk_done(name, k, stats.rows):
+            file_done(name)
+        else:
+            manifest.save()
+
+    # a chunk with identifiers that cannot be stored as BIGINT (--typed-ids) is reported, and its file is left unfinished
+    failed = set()
+    def task_failed(name, error):
+        print('could not convert:', name, '-', error)
+        failed.add(name)
+
+    def run_tasks(tasks, profiler=None):
+        for task in tasks:
+            if profiler:
+                profiler.enable()
+            try:
+                stats = task[2](*task[3])
+            except ValueError as error:
+                task_failed(task[0], error)
+                continue
+            finally:
+                if profiler:
+                    profiler.disable()
+            task_done(*task[:2], stats)
+
+    def run_profiled():
+        if not profiled:
+            return
+        import cProfile
+        import pstats
+        print('profiling', args.profile, 'in process', os.getpid(), '(py-spy can attach to it, e.g. py-spy top --pid ' + str(os.getpid()) + ')')
+        profiler = cProfile.Profile()
+        run_tasks(profiled, profiler)
+        profiler.dump_stats(path_to + '/profile-' + args.profile + '.prof')
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(20)
+        print('Profile of', args.profile, 'written to', path_to + '/profile-' + args.profile + '.prof')
+
+    for name in to_finish:
+        file_done(name)
+    if pool:
+        with pool:
+            futures = {pool.submit(task[2], *task[3]): task[:2] for task in tasks}
+            run_profiled()
+            for future in as_completed(futures):
+                try:
+                    stats = future.result()
+                except ValueError as error:
+                    task_failed(futures[future][0], error)
+                    continue
+                task_done(*futures[future], stats)
+    else:
+        run_profiled()
+        run_tasks(tasks)
+
+    print_rate('All files', rows_converted, time.perf_counter() - run_start)
+    # where the time went, from the run report: per stage (summed over the workers) and the slowest tables
+    report = run_report.save()
+    stage_seconds = sum(report['stages'].values())
+    if stage_seconds > 0:
+        print('Seconds per stage:', ' | '.join(stage + ': ' + str(round(seconds, 2)) + ' (' + str(round(100 * seconds / stage_seconds)) + '%)' for stage, seconds in report['stages'].items()))
+        for table, summary in sorted(report['tables'].items(), key=lambda x: -x[1]['seconds'])[:5]:
+            print_rate('  ' + table, summary['rows'], summary['seconds'])
+    print('Peak memory (MB):', report['peak_rss_mb'], '| run report:', run_report.path + ('' if run_report.files else ' (nothing converted, left as is)'))
+    if failed:
+        print('Not converted:', sorted(failed), '- correct these files, or convert without --typed-ids into another directory')
@@ -1,62 +1,181 @@
-# Code snippet to generate a file containing SQL queries which creates the individual tables, loads in data from data csv files, and reads the data 
-# Run as: python Step1C-Generate-SQL-queries.py path-to-files  metadata_version
+# Code snippet to generate a file containing SQL queries which creates the individual tables, loads in data from data csv files, and finalises the tables
+# Run as: python Step1C-Generate-SQL-queries.py path-to-files  metadata_version [--incremental [--dsn "dbname=cprd"]] [--split] [--partition-by patid|year] [--typed-ids]
 # E.g. python Step1C-Generate-SQL-queries.py /proc-data/SYN_AURUM v2p9
-# User gives the directory path which should contain two sub directories 'metadata_csv' and 'data_csv' created & populated from Step1A and Step1B respectively 
+# User gives the directory path which should contain two sub directories 'metadata_csv' and 'data_csv' created & populated from Step1A and Step1B respectively
+# The numbered part files of a table (e.g. Observation_001.csv, Observation_002.csv) are all copied into the same table
+# Each COPY runs in a transaction with an INSERT into the aurum_load_log table, which records the file and the content hash of
+# its txt file (from the manifest written by Step1B): a file is only recorded as loaded once its COPY has committed
+# With --incremental, only the tables with new or changed data csv files since the last load are included: the load log is read
+# from the --dsn database (needs the psycopg2 library), and a table that only gained new part files, or has files whose COPY
+# did not commit, gets COPY statements for these files only, while a table with a changed or removed file is dropped,
+# re-created and reloaded; a table still UNLOGGED (the earlier plan stopped before finalising it) is finalised in full
+# The tables are created UNLOGGED and loaded without keys or indexes; once loaded, they are SET LOGGED, then the primary keys
+# (from the metadata descriptions), indexes on the fields linking to other tables and dictionaries ('Link ... table' in the
+# metadata mapping) and BRIN indexes on the date fields are built, and the tables are ANALYZEd
+# With --split, the table creation, the COPY of each data csv file and the finalising are written to separate files,
+# so that the COPY files can be run in parallel sessions
+# With --partition-by patid or year, the Observation and DrugIssue tables are created as partitioned tables: hash partitions
+# on patid (e.g. Observation_p00 ... Observation_p15), or one range partition per year of the event date (e.g. Observation_y2015)
+# Once Patient and Practice are loaded, a PatientSummary table is created (or refreshed, after an incremental run) with one row per
+# patient: acceptable flag, registration and death dates, follow-up start/end/days (as defined in the Step2B notebook, from
+# --followup-start and --release-date) and the practice's lcd and region
+# The partitioning is taken from the Step1B manifest when Step1B pre-split its csv files; each year file or patid shard is
+# copied straight into its partition
+# With --typed-ids (the default when Step1B was run with --typed-ids, which it requires), the numeric identifier columns
+# (patid, obsid, medcodeid, prodcodeid, ...) are created as BIGINT instead of TEXT
+# Compressed csv files (Step1B --compress) are loaded with COPY ... FROM PROGRAM 'gzip -dc ...' (or 'zstd -dcq ...'), which runs
+# the decompression on the database server: it needs gzip/zstd there and a superuser or a member of pg_execute_server_program
+# With --progress, the SQL files are written for psql: with \timing on, and an \echo before each COPY (with the MB loaded so far
+# out of the total) and each finalised table, so that the psql output shows the progress of the load and the time of each step
 
 # Libraries
 import os
+import sys
+import argparse
 import csv
-import pandas as pd
+import aurum_utils
 
-# Inputs and directories 
-data_input_path = sys.argv[1] + '/data_csv' #directory containing csv data files
-metadata_input_path = sys.argv[1] + '/metadata_csv' #directory containing csv metadata files
-output_path = sys.argv[1] + '/create-tables' 
-metadata_version = sys.argv[2]
+# Inputs and directories
+parser = argparse.ArgumentParser(description='Generate the SQL to create and load the tables from the Step1B csv files')
+parser.add_argument('path', help='directory containing the metadata_csv and data_csv sub-directories')
+parser.add_argument('metadata_version', help='version suffix of the metadata csv files, e.g. v2p9')
+parser.add_argument('--incremental', action='store_true', help='only include new or changed data csv files since the last load, as recorded in the database')
+parser.add_argument('--dsn', default='', help='with --incremental: libpq connection string of the database loaded by the SQL, e.g. "dbname=cprd" (default: libpq defaults/PG* environment variables)')
+parser.add_argument('--split', action='store_true', help='write the COPY of each data csv file to its own file in create-tables/copy, to run in parallel sessions')
+parser.add_argument('--release-date', default='2021-10-01', help='release date of the data, the end of follow-up of patients still registered (default: 2021-10-01)')
+parser.add_argument('--followup-start', default='1995-01-01', help='follow-up starts at the registration start date, or at this date if later (default: 1995-01-01)')
+parser.add_argument('--partition-by', choices=['patid', 'year'], help='create Observation and DrugIssue as partitioned tables, on patid or the year of the event date (default: as pre-split by Step1B, else not partitioned)')
+parser.add_argument('--partitions', type=int, default=16, help='with --partition-by patid: number of hash partitions (default: 16)')
+parser.add_argument('--years', default='1990-2022', help='with --partition-by year: first and last year with their own partition (default: 1990-2022)')
+parser.add_argument('--typed-ids', action='store_true', help='create the numeric identifier columns as BIGINT (default: if the csv files were checked by Step1B --typed-ids)')
+parser.add_argument('--progress', action='store_true', help='write psql \\timing and \\echo commands into the SQL files, to show the progress and time of each step of the load')
+args = parser.parse_args()
+
+data_input_path = os.path.abspath(args.path + '/data_csv') #directory containing csv data files
+metadata_input_path = args.path + '/metadata_csv' #directory containing csv metadata files
+output_path = args.path + '/create-tables'
+metadata_version = args.metadata_version
 
 ## ! don't change code below
 
-#assignment
-directory = os.fsencode(data_input_path)
-list_csv= []
-
-#loop over data files in directory    
-for file in os.listdir(directory):
-     filename = os.fsdecode(file)
-     if filename.endswith(".csv"): 
-        #filename without csv extension
-        name = filename.split('.')[0]
-        print('name:', name)
-        #read metadata to dataframe and replace datatypes to psql compatible format
-        df = pd.read_csv(metadata_input_path + name + "-" + metadata_version + ".csv")
-        df = df.replace('INTEGER','INT')
-        # zip column field names and data types
-        if 'Dictionary' in name:
-         pairs = zip(df['Column name'],df['Type'])
-         field_name =  df['Column name']
+os.makedirs(output_path, exist_ok=True)
+manifest = aurum_utils.Manifest(data_input_path + '/manifest.json')
+if args.incremental and not manifest.files:
+    sys.exit('--incremental needs the manifest.json written by Step1B in ' + data_input_path)
+
+# the files loaded so far, from the load log that the SQL of the earlier runs wrote to as their COPY statements committed
+# (a file whose COPY failed, or whose SQL was never run, is not in it), and the tables still UNLOGGED: the earlier plan stopped
+# before finalising them (a COPY failed under ON_ERROR_STOP, or the --split finalise file was not run)
+loaded = {} # {table: {file name: content hash}}
+unfinalised = set()
+if args.incremental:
+    import psycopg2
+    with psycopg2.connect(args.dsn) as connection, connection.cursor() as cursor:
+        cursor.execute("SELECT to_regclass('aurum_load_log')")
+        if cursor.fetchone()[0] is None:
+            print('No aurum_load_log table in the database: all tables are loaded')
         else:
-         pairs = zip(df['Field name'],df['Type'])
-         field_name =  df['Field name']
-        no_fields = len(df['Type'])
-        #print('no_fields:', no_fields)
-        
-        # append complete SQL query to csv file
-        list_csv.append( "DROP TABLE IF EXISTS " + name + ";\n" + \
-        "CREATE TABLE " + name +  " ("+ \
-        " ".join([p[1][0] + " " + p[1][1] + "," if p[0]+1 != no_fields else p[1][0] + " " + p[1][1] for p in enumerate(pairs) ]) + \
-        "); \n"  + "COPY " + name + "(" + \
-        " ".join(f[1] + "," if f[0]+1 != no_fields else f[1] for f in enumerate(field_name)) + \
-        ") FROM '" + data_input_path + filename + "' WITH (FORMAT 'csv', DELIMITER ',', HEADER, QUOTE '\"'); \n" + \
-        'SELECT * FROM ' + name + ' LIMIT 5; \n'         
-      )
-
-        print('done, next')
-        continue
-     else:
-        print('No csv files found in directory specified.')
+            cursor.execute('SELECT table_name, name, sha256 FROM aurum_load_log WHERE chunk = 0')
+            for table, name, sha256 in cursor.fetchall():
+                loaded.setdefault(table, {})[name] = sha256
+            for table in loaded:
+                cursor.execute(aurum_utils.UNLOGGED_SQL, {'table': table})
+                if cursor.fetchone()[0]:
+                    unfinalised.add(table)
+    connection.close()
+partitioning = aurum_utils.parse_partitioning(args.partition_by, args.partitions, args.years)
+split_with = manifest.options.get('partitioning')
+if split_with and partitioning is None:
+    partitioning = aurum_utils.Partitioning(**split_with)
+elif split_with and partitioning.options() != split_with:
+    sys.exit('The csv files were split by Step1B with ' + str(split_with) + ', use the same partitioning or none')
+typed_ids = manifest.options.get('typed_ids', False)
+if args.typed_ids and not typed_ids:
+    sys.exit('--typed-ids needs csv files whose identifiers were checked by Step1B --typed-ids')
+
+# data csv files grouped by table (only files which Step1B has finished, when there is a manifest)
+files_per_table = {}
+csv_paths = dict(aurum_utils.data_csv_files(data_input_path, manifest))
+for name in csv_paths:
+    files_per_table.setdefault(aurum_utils.table_name(name), []).append(name)
+if not files_per_table:
+    print('No csv files found in directory specified.')
+
+# the load plan, in three parts: create the (unlogged) tables, copy the data in, then finalise the tables
+create_sql, copy_sql, finalise_sql = [aurum_utils.LOAD_LOG_SQL + ';\n'], {}, []
+finalised_tables = [] # the table of each finalise_sql statement
+loaded_tables = []
+for table, names in sorted(files_per_table.items()):
+    current = {name: manifest.files.get(name.split('__')[0], {}).get('sha256') for name in names}
+    previous = loaded.get(table, {})
+
+    # what has to be (re)loaded for this table
+    if not args.incremental or not previous or any(current.get(name) != sha for name, sha in previous.items()):
+        to_copy, recreate = names, True
+    else:
+        to_copy, recreate = [name for name in names if name not in previous], False
+    if not to_copy and table not in unfinalised:
+        print('unchanged:', table)
         continue
+    print('name:', table, '| files:', to_copy, '| re-create table' if recreate else '| append', '| finalise' if not recreate and table in unfinalised else '')
+    loaded_tables.append(table)
+
+    # a re-created table is loaded UNLOGGED with no keys or indexes, which are only built once all the data is in
+    # a table that is only appended to already has them, so it just needs new statistics, unless it was never finalised
+    if recreate or table in unfinalised:
+        fields = aurum_utils.read_metadata(metadata_input_path, table, metadata_version)
+        if typed_ids:
+            fields = aurum_utils.typed_id_fields(fields)
+        if recreate:
+            create_sql.append(aurum_utils.create_table_sql(table, fields, unlogged=True, partitioning=partitioning))
+            create_sql[-1] += "DELETE FROM aurum_load_log WHERE table_name = '" + table + "';\n"
+        finalise_sql.append(aurum_utils.finalise_table_sql(table, fields, partitioning))
+        finalised_tables.append(table)
+    else:
+        finalise_sql.append('ANALYZE ' + table + ';\n')
+        finalised_tables.append(table)
+    for name in to_copy:
+        with aurum_utils.open_csv(csv_paths[name]) as csv_file:
+            field_name = next(csv.reader(csv_file), [])
+        target = partitioning.copy_target(table, name.split('__')[1]) if partitioning and '__' in name else table
+        # a compressed csv file is decompressed by gzip/zstd on the database server, through COPY FROM PROGRAM
+        source = ("PROGRAM '" + aurum_utils.decompress_program(csv_paths[name]) + "'") if csv_paths[name].endswith(('.gz', '.zst')) else ("'" + csv_paths[name] + "'")
+        # the file is recorded in the load log only if its COPY commits
+        copy_sql[name] = ("BEGIN;\nCOPY " + target + "(" + ", ".join(field_name) + ") FROM " + source + " WITH (FORMAT 'csv', DELIMITER ',', HEADER, QUOTE '\"');\n"
+                          + "INSERT INTO aurum_load_log VALUES ('" + table + "', '" + name + "', '" + (current[name] or '') + "', 0, NULL) ON CONFLICT DO NOTHING;\nCOMMIT;\n")
+    print('done, next')
+
+# the patient summary, refreshed whenever Patient or Practice are (re)loaded
+if 'Patient' in files_per_table and 'Practice' in files_per_table and ('Patient' in loaded_tables or 'Practice' in loaded_tables):
+    print('name: PatientSummary | from Patient and Practice')
+    finalise_sql.append(aurum_utils.patient_summary_sql(args.release_date, args.followup_start, typed_ids))
+    finalised_tables.append('PatientSummary')
+
+# with --progress, psql prints the time of each statement, and where the load is before each COPY and each finalised table
+if args.progress:
+    total_bytes = sum(os.path.getsize(csv_paths[name]) for name in copy_sql)
+    loaded_bytes = 0
+    for i, name in enumerate(copy_sql):
+        loaded_bytes += os.path.getsize(csv_paths[name])
+        copy_sql[name] = ("\\timing on\n\\echo '[" + str(i + 1) + "/" + str(len(copy_sql)) + "] " + name + ": " + str(round(os.path.getsize(csv_paths[name]) / 1e6, 1))
+                          + " MB, " + str(round(loaded_bytes / 1e6, 1)) + " of " + str(round(total_bytes / 1e6, 1)) + " MB once loaded'\n" + copy_sql[name])
+    finalise_sql = ["\\timing on\n"] + ["\\echo 'finalise: " + table + "'\n" + sql for table, sql in zip(finalised_tables, finalise_sql)]
 
-# write contents list_csv into a file (that can be run to create tables in sql)
-with open(output_path + '/Step1C-create-tables.sql', 'w', newline = '') as csvfile:
-    csvwriter = csv.writer(csvfile, delimiter = '\n', quoting = csv.QUOTE_NONE, escapechar = '\t')
-    csvwriter.writerow(list_csv)
+# write the plan into a file (that can be run to create tables in sql), or with --split into
+# separate files so that the COPY of each data csv file can run in its own session, in parallel
+if args.split:
+    copy_path = output_path + '/copy'
+    os.makedirs(copy_path, exist_ok=True)
+    for filename in os.listdir(copy_path):
+        os.remove(copy_path + '/' + filename)
+    for name, sql in copy_sql.items():
+        with open(copy_path + '/' + name + '.sql', 'w', newline = '') as sql_file:
+            sql_file.write(sql)
+    with open(output_path + '/Step1C-create-tables.sql', 'w', newline = '') as sql_file:
+        sql_file.write('\n'.join(create_sql))
+    with open(output_path + '/Step1C-finalise-tables.sql', 'w', newline = '') as sql_file:
+        sql_file.write('\n'.join(finalise_sql))
+    print('Run', output_path + '/Step1C-create-tables.sql, then the files in', copy_path, '(in parallel, e.g. ls ' + copy_path + '/*.sql | xargs -P 8 -n 1 psql -f), then', output_path + '/Step1C-finalise-tables.sql')
+else:
+    with open(output_path + '/Step1C-create-tables.sql', 'w', newline = '') as sql_file:
+        sql_file.write('\n'.join(create_sql + list(copy_sql.values()) + finalise_sql))
@@ -0,0 +1,249 @@
+# Code snippet to load the cprd txt files straight into PostgreSQL, as an alternative to Step1B + Step1C
+# Run as: python Step1D-Load-data-postgres.py path-to-text-files [--dsn "host=localhost dbname=cprd user=me"] [--workers N] [--partition-by patid|year] [--typed-ids]
+# E.g. python Step1D-Load-data-postgres.py /proc-data/SYN_AURUM --dsn "dbname=cprd" --workers 4
+# User gives the directory path which contains the cprd txt files and the 'metadata_csv' sub-directory from Step1A
+# (the txt files can be compressed, .txt.gz/.txt.zst or in .zip archives, and are then read as in Step1B, by a single worker each)
+# Rows are converted as in Step1B (from the metadata types: dates to YYYY-MM-DD, numbers stripped, blanks to NULL) and
+# streamed to the server with COPY ... FROM STDIN, so no data csv files are written and the server does not need access to the files
+# Tables are created from the metadata types, then loaded by N worker processes, each holding its own connection:
+# several tables (and byte-range chunks of big files) load at the same time
+# As in the Step1C load plan, new tables are created UNLOGGED, and their keys and indexes are only built once they are loaded
+# With --partition-by patid or year, the Observation and DrugIssue tables are created as partitioned tables (as in Step1C),
+# and the rows are copied into the partitioned table, which routes them to their partition
+# Once Patient and Practice are loaded, the PatientSummary table is created or refreshed, as in Step1C
+# With --typed-ids, the numeric identifier columns are created as BIGINT and their values checked as in Step1B --typed-ids:
+# a chunk with a value that would not read back unchanged is rolled back and reported, and loaded again by the next run
+# A manifest records what has been loaded: a re-run only loads new or changed files, and resumes from the last loaded chunk
+# Each chunk is also recorded in a load log table (aurum_load_log), in the same transaction as its COPY, so a chunk that was
+# committed but not written to the manifest (e.g. the run was killed) is not loaded twice by the next run
+# The connection uses libpq defaults and the PGHOST/PGDATABASE/PGUSER/PGPASSWORD environment variables for anything not in --dsn
+
+## Libraries
+import os
+import argparse
+import time
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import psycopg2
+import aurum_utils
+
+## Functions
+connection = None # each worker process holds one connection, opened by open_connection
+
+def open_connection(dsn):
+    global connection
+    connection = psycopg2.connect(dsn)
+
+def load_chunk(table, txt_path, header, start, end, batch_size, fields, name, sha256, k):
+    # converts the rows of txt_path starting within [start, end) and copies them into table, recording chunk k of the file
+    # in the load log in the same transaction
+    # returns the number of rows loaded, the number of bytes read and the start/end time of the load
+    started = time.time()
+    invalid_ids = [] # psycopg2 cancels the COPY when reading the stream fails, this keeps the original error
+    def batches():
+        try:
+            yield from aurum_utils.converted_batches(txt_path, header, start, end, batch_size, fields)
+        except ValueError as error:
+            invalid_ids.append(error)
+            raise
+    stream = aurum_utils.CsvStream(batches())
+    try:
+        with connection.cursor() as cursor:
+            cursor.copy_expert('COPY ' + table + ' (' + ', '.join(header) + ") FROM STDIN WITH (FORMAT 'csv', DELIMITER ',', QUOTE '\"')", stream, size=1024 * 1024)
+            cursor.execute('INSERT INTO aurum_load_log VALUES (%s, %s, %s, %s, %s)', (table, name, sha256, k, stream.n_rows))
+    except psycopg2.Error:
+        connection.rollback()
+        if invalid_ids: # identifiers that cannot be stored as BIGINT, nothing of the chunk is kept
+            raise invalid_ids[0]
+        raise
+    connection.commit()
+    return stream.n_rows, end - start, started, time.time()
+
+def finalise_table(table, fields, partitioning):
+    # once all its files are loaded: makes a table that was created UNLOGGED LOGGED, then builds its keys and indexes
+    # and ANALYZEs it (aurum_utils.finalise_table_sql), in one transaction; a table that was only appended to is just ANALYZEd
+    # returns the number of seconds it took
+    started = time.time()
+    with connection.cursor() as cursor:
+        cursor.execute(aurum_utils.UNLOGGED_SQL, {'table': table})
+        unlogged = cursor.fetchone()[0]
+        try:
+            cursor.execute(aurum_utils.finalise_table_sql(table, fields, partitioning) if unlogged else 'ANALYZE ' + table)
+        except psycopg2.Error:
+            connection.rollback()
+            raise
+    connection.commit()
+    return time.time() - started
+
+
+if __name__ == '__main__':
+    ## Inputs and directories
+    parser = argparse.ArgumentParser(description='Load CPRD Aurum txt files straight into PostgreSQL')
+    parser.add_argument('path_from', help='directory containing the cprd txt files')
+    parser.add_argument('--dsn', default='', help='libpq connection string, e.g. "host=localhost dbname=cprd user=me" (default: libpq defaults/PG* environment variables)')
+    parser.add_argument('--metadata-path', help='directory of the Step1A metadata csv files (default: path_from/metadata_csv)')
+    parser.add_argument('--metadata-version', default='v2p9', help='version suffix of the metadata csv files (default: v2p9)')
+    parser.add_argument('--workers', type=int, default=4, help='number of connections loading concurrently (default: 4)')
+    parser.add_argument('--chunk-size', type=int, default=512, help='files bigger than this many MB are loaded as parallel chunks of this size (default: 512)')
+    parser.add_argument('--batch-size', type=int, default=100000, help='number of rows held in memory at any one time, per worker (default: 100000)')
+    parser.add_argument('--release-date', default='2021-10-01', help='release date of the data, the end of follow-up of patients still registered (default: 2021-10-01)')
+    parser.add_argument('--followup-start', default='1995-01-01', help='follow-up starts at the registration start date, or at this date if later (default: 1995-01-01)')
+    parser.add_argument('--partition-by', choices=['patid', 'year'], help='create Observation and DrugIssue as partitioned tables, on patid or the year of the event date')
+    parser.add_argument('--partitions', type=int, default=16, help='with --partition-by patid: number of hash partitions (default: 16)')
+    parser.add_argument('--years', default='1990-2022', help='with --partition-by year: first and last year with their own partition (default: 1990-2022)')
+    parser.add_argument('--typed-ids', action='store_true', help='create the numeric identifier columns as BIGINT, checking their values as they are loaded')
+    parser.add_argument('--manifest', help='json record of the loaded files, so that re-runs only load new or changed files (default: path_from/load_manifest.json)')
+    args = parser.parse_args()
+
+    path_from = args.path_from
+    metadata_path = args.metadata_path or path_from + '/metadata_csv'
+    partitioning = aurum_utils.parse_partitioning(args.partition_by, args.partitions, args.years)
+
+    ## ! don't change code below
+
+    # group the txt files (including numbered part files) by table
+    txt_paths = aurum_utils.txt_sources(path_from)
+    files_per_table = {}
+    for name in sorted(txt_paths):
+        files_per_table.setdefault(aurum_utils.table_name(name), []).append(name)
+
+    # the manifest records each loaded txt file, so a re-run only loads new or changed files and resumes unfinished ones
+    # (a chunk committed but not yet recorded in the manifest is found in the load log table, see below)
+    manifest = aurum_utils.Manifest(args.manifest or path_from + '/load_manifest.json')
+    options = {'dsn': args.dsn}
+    if partitioning:
+        options['partitioning'] = partitioning.options()
+    if args.typed_ids:
+        options['typed_ids'] = True
+    if manifest.files and manifest.options != options:
+        print('The manifest', manifest.path, 'records loads into a different database, partitioning or typing', manifest.options, '- use --manifest to give another one. Exiting!')
+        exit()
+    manifest.options = options
+
+    pool = ProcessPoolExecutor(max_workers=args.workers, initializer=open_connection, initargs=(args.dsn,))
+
+    # content hash of the txt files, only recomputed for files whose size or mtime differs from the manifest
+    to_hash = [name for name in txt_paths if not manifest.is_unchanged(name, txt_paths[name])]
+    print('hashing', len(to_hash), 'new or modified files')
+    hashes = dict(zip(to_hash, pool.map(aurum_utils.file_sha256, [txt_paths[name] for name in to_hash])))
+
+    # (re)create the tables from their metadata where needed, and split the files still to load into tasks:
+    # - a table seen for the first time, or with a changed or removed file, is re-created and all its files are loaded
+    # - otherwise only its new files are appended, and unfinished files resume from their last loaded chunk
+    tasks = []
+    table_fields = {}
+    to_finalise = [] # tables fully loaded by an earlier run that stopped before finalising them
+    with psycopg2.connect(args.dsn) as ddl_connection, ddl_connection.cursor() as cursor:
+        cursor.execute(aurum_utils.LOAD_LOG_SQL)
+        ddl_connection.commit()
+        for table, names in sorted(files_per_table.items()):
+            try:
+                fields = aurum_utils.read_metadata(metadata_path, table, args.metadata_version)
+            except FileNotFoundError as error:
+                print(error, '- skipping', names)
+                continue
+            if args.typed_ids:
+                fields = aurum_utils.typed_id_fields(fields)
+            statuses = {name: manifest.check(name, txt_paths[name], hashes.get(name) or manifest.files[name]['sha256']) for name in names}
+            removed = [name for name in manifest.files if aurum_utils.table_name(name) == table and name not in names]
+            changed = [name for name in names if statuses[name] == 'new' and name in manifest.files]
+            if removed or changed or not any(name in manifest.files for name in names):
+                print('creating:', table)
+                cursor.execute(aurum_utils.create_table_sql(table, fields, unlogged=True, partitioning=partitioning))
+                cursor.execute('DELETE FROM aurum_load_log WHERE table_name = %s', (table,))
+                ddl_connection.commit()
+                for name in removed:
+                    del manifest.files[name]
+                to_start = names
+            else:
+                to_start = [name for name in names if statuses[name] == 'new']
+                if len(to_start) + sum(status == 'resume' for status in statuses.values()) == 0:
+                    print('unchanged:', table)
+            for name in to_start:
+                header, data_start = aurum_utils.read_header(txt_paths[name])
+                manifest.start(name, txt_paths[name], hashes.get(name) or manifest.files[name]['sha256'],
+                               aurum_utils.txt_byte_ranges(txt_paths[name], data_start, args.chunk_size * 1024 * 1024))
+            # chunks committed by an earlier run but missing from the manifest (it stopped before saving it) are not loaded again
+            cursor.execute('SELECT name, sha256, chunk, n_rows FROM aurum_load_log WHERE table_name = %s', (table,))
+            for name, sha256, k, n_rows in cursor.fetchall():
+                entry = manifest.files.get(name)
+                if entry and entry['status'] != 'done' and entry['sha256'] == sha256 and k not in entry['chunks_done']:
+                    if manifest.chunk_done(name, k, n_rows):
+                        entry['status'] = 'done'
+            for name in names:
+                entry = manifest.files[name]
+                if entry['status'] == 'done':
+                    continue
+                header, data_start = aurum_utils.read_header(txt_paths[name])
+                for k, (start, end) in enumerate(entry['byte_ranges']):
+                    if k not in entry['chunks_done']:
+                        tasks.append((name, k, (table, txt_paths[name], header, start, end, args.batch_size, fields, name, entry['sha256'], k)))
+            table_fields[table] = fields
+            if not any(task[2][0] == table for task in tasks):
+                cursor.execute(aurum_utils.UNLOGGED_SQL, {'table': table})
+                if cursor.fetchone()[0]:
+                    to_finalise.append(table)
+    ddl_connection.close()
+    manifest.save()
+
+    # load the biggest chunks first, so that they do not hold up the end of the run
+    tasks.sort(key=lambda task: task[2][3] - task[2][4])
+    run_start = time.time()
+    stats = {} # per table: rows, bytes, first start, last end
+    # each table is finalised as soon as all of its chunks are loaded, while the other tables carry on loading
+    tasks_left = {}
+    for task in tasks:
+        tasks_left[task[2][0]] = tasks_left.get(task[2][0], 0) + 1
+    with pool:
+        pending = {pool.submit(load_chunk, *task[2]): task for task in tasks}
+        for table in to_finalise:
+            pending[pool.submit(finalise_table, table, table_fields[table], partitioning)] = ('finalise', table)
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                task = pending.pop(future)
+                if task[0] == 'finalise':
+                    # e.g. duplicated primary key values: the table is left UNLOGGED and finalising is tried again by the next run
+                    try:
+                        print('finalised:', task[1], '| seconds:', round(future.result(), 2))
+                    except psycopg2.Error as error:
+                        print('could not finalise', task[1], '-', str(error).strip())
+                    continue
+                name, k, (table, txt_path) = task[0], task[1], task[2][:2]
+                try:
+                    n_rows, n_bytes, started, finished = future.result()
+                except (ValueError, psycopg2.Error) as error: # the table is not finalised, the chunk is loaded again by the next run
+                    # (e.g. a value that does not fit its column type); the other chunks carry on and are still recorded
+                    print('could not load:', table, os.path.basename(txt_path), '-', str(error).strip())
+                    continue
+                rows, total_bytes, first, last = stats.get(table, (0, 0, started, finished))
+                stats[table] = (rows + n_rows, total_bytes + n_bytes, min(first, started), max(last, finished))
+                print('loaded:', table, os.path.basename(txt_path), '| rows:', n_rows)
+                if manifest.chunk_done(name, k, n_rows):
+                    manifest.file_done(name)
+                else:
+                    manifest.save()
+                tasks_left[table] -= 1
+                if tasks_left[table] == 0:
+                    pending[pool.submit(finalise_table, table, table_fields[table], partitioning)] = ('finalise', table)
+
+    # the patient summary, refreshed whenever Patient or Practice were loaded (or it is missing)
+    if 'Patient' in table_fields and 'Practice' in table_fields:
+        with psycopg2.connect(args.dsn) as summary_connection, summary_connection.cursor() as cursor:
+            cursor.execute("SELECT to_regclass('PatientSummary')")
+            if 'Patient' in stats or 'Practice' in stats or cursor.fetchone()[0] is None:
+                started = time.time()
+                try:
+                    cursor.execute(aurum_utils.patient_summary_sql(args.release_date, args.followup_start, args.typed_ids))
+                    print('PatientSummary refreshed | seconds:', round(time.time() - started, 2))
+                except psycopg2.Error as error:
+                    print('could not refresh PatientSummary -', str(error).strip())
+        summary_connection.close()
+
+    # report load rates per table
+    print('\n' + 'table'.ljust(20), 'rows'.rjust(12), 'seconds'.rjust(9), 'rows/sec'.rjust(10), 'MB/sec'.rjust(8))
+    for table, (rows, total_bytes, first, last) in sorted(stats.items()):
+        elapsed = max(last - first, 1e-9)
+        print(table.ljust(20), str(rows).rjust(12), str(round(elapsed, 2)).rjust(9), str(round(rows / elapsed)).rjust(10), str(round(total_bytes / elapsed / 1e6, 1)).rjust(8))
+    elapsed = time.time() - run_start
+    total_rows = sum(s[0] for s in stats.values())
+    print('All tables'.ljust(20), str(total_rows).rjust(12), str(round(elapsed, 2)).rjust(9), str(round(total_rows / elapsed)).rjust(10))
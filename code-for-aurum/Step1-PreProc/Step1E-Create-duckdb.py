@@ -0,0 +1,95 @@
+# Code snippet to query the Step1B files in-process with DuckDB, as an alternative to loading them into PostgreSQL (Step1C/Step1D)
+# Run as: python Step1E-Create-duckdb.py path-to-files metadata_version [--format csv|parquet] [--database path] [--materialize] [--analysis]
+# E.g. python Step1E-Create-duckdb.py /proc-data/SYN_AURUM v2p9 --format parquet
+# User gives the directory path which should contain the 'metadata_csv' sub-directory from Step1A and the 'data_csv'
+# (or 'data_parquet') sub-directory from Step1B
+# A DuckDB database file (by default path-to-files/cprd.duckdb) is created with one view per table over its csv/parquet files:
+# the csv columns are typed from the Step1A metadata as in Step1C, the parquet files already carry their types
+# (the numeric identifiers are BIGINT when Step1B checked them with --typed-ids, as recorded in its manifest)
+# The numbered part files of a table (and the partition files of Observation and DrugIssue) are all read by the same view
+# As in Step1C, a PatientSummary table is created from Patient and Practice, with one row per patient (follow-up from
+# --followup-start and --release-date as in the Step2B notebook)
+# With --materialize, the tables are loaded into the database file instead of read from the files at each query
+# With --analysis, the analysis-ready tables of Step1F (the 'data_analysis' sub-directory) are added too, named with an
+# 'Analysis' suffix (e.g. ObservationAnalysis), with the lookup descriptions and dictionary terms next to their fields
+# Needs the duckdb library; there is no server to run, queries run in the notebook's own process, on all cores
+
+## Libraries
+import os
+import argparse
+import time
+import duckdb
+import aurum_utils
+
+## Inputs and directories
+parser = argparse.ArgumentParser(description='Create a DuckDB database over the Step1B csv (or parquet) files')
+parser.add_argument('path', help='directory containing the metadata_csv and data_csv (or data_parquet) sub-directories')
+parser.add_argument('metadata_version', help='version suffix of the metadata csv files, e.g. v2p9')
+parser.add_argument('--format', choices=['csv', 'parquet'], default='csv', help='which Step1B output to read (default: csv)')
+parser.add_argument('--database', help='DuckDB database file to create or update (default: path/cprd.duckdb)')
+parser.add_argument('--materialize', action='store_true', help='load the data into the database file, instead of creating views reading the files')
+parser.add_argument('--release-date', default='2021-10-01', help='release date of the data, the end of follow-up of patients still registered (default: 2021-10-01)')
+parser.add_argument('--followup-start', default='1995-01-01', help='follow-up starts at the registration start date, or at this date if later (default: 1995-01-01)')
+parser.add_argument('--threads', type=int, help='number of threads DuckDB uses (default: all cores)')
+parser.add_argument('--analysis', action='store_true', help='also add the Step1F analysis-ready tables (path/data_analysis), e.g. as ObservationAnalysis')
+args = parser.parse_args()
+
+data_input_path = os.path.abspath(args.path + '/data_' + args.format) # the views hold absolute paths
+metadata_input_path = args.path + '/metadata_csv'
+database_path = args.database or args.path + '/cprd.duckdb'
+analysis_input_path = os.path.abspath(args.path + '/data_analysis')
+
+## ! don't change code below
+
+# data files grouped by table (only files which Step1B has finished, when there is a manifest)
+manifest = aurum_utils.Manifest(data_input_path + '/manifest.json')
+sources = {}
+if args.format == 'csv':
+    files_per_table = {}
+    for name, csv_path in aurum_utils.data_csv_files(data_input_path, manifest):
+        files_per_table.setdefault(aurum_utils.table_name(name), []).append(csv_path)
+    for table, csv_paths in files_per_table.items():
+        try:
+            fields = aurum_utils.read_metadata(metadata_input_path, table, args.metadata_version)
+        except FileNotFoundError as error:
+            print(error, '- all columns of', table, 'are read as VARCHAR')
+            fields = []
+        if manifest.options.get('typed_ids'):
+            fields = aurum_utils.typed_id_fields(fields)
+        sources[table] = aurum_utils.duckdb_csv_sql(csv_paths, fields)
+else:
+    for table in sorted(os.listdir(data_input_path)):
+        if os.path.isdir(data_input_path + '/' + table):
+            sources[table] = aurum_utils.duckdb_parquet_sql(data_input_path + '/' + table)
+if not sources:
+    print('No', args.format, 'files found in directory specified.')
+if args.analysis and os.path.isdir(analysis_input_path):
+    for table in sorted(os.listdir(analysis_input_path)):
+        if os.path.isdir(analysis_input_path + '/' + table):
+            sources[table + 'Analysis'] = aurum_utils.duckdb_parquet_sql(analysis_input_path + '/' + table)
+elif args.analysis:
+    print('No', analysis_input_path, 'directory, run Step1F first.')
+
+connection = duckdb.connect(database_path)
+if args.threads:
+    connection.execute('SET threads = ' + str(args.threads))
+for table, source in sorted(sources.items()):
+    # a table replaces a view of the same name and the other way round, so drop whichever is there
+    for kind in ['VIEW', 'TABLE']:
+        connection.execute("SELECT count(*) FROM duckdb_" + kind.lower() + "s() WHERE " + kind.lower() + "_name = ? AND NOT internal", [table])
+        if connection.fetchone()[0]:
+            connection.execute('DROP ' + kind + ' ' + table)
+    started = time.perf_counter()
+    if args.materialize:
+        connection.execute('CREATE TABLE ' + table + ' AS SELECT * FROM ' + source)
+        n_rows = connection.execute('SELECT count(*) FROM ' + table).fetchone()[0]
+        print('name:', table, '| rows:', n_rows, '| seconds:', round(time.perf_counter() - started, 2))
+    else:
+        connection.execute('CREATE VIEW ' + table + ' AS SELECT * FROM ' + source)
+        print('name:', table, '| view over', args.format, 'files')
+if 'Patient' in sources and 'Practice' in sources:
+    started = time.perf_counter()
+    connection.execute('CREATE OR REPLACE TABLE PatientSummary AS ' + aurum_utils.patient_summary_select_sql(args.release_date, args.followup_start))
+    print('name: PatientSummary | seconds:', round(time.perf_counter() - started, 2))
+connection.close()
+print('Created', database_path, '- connect to it from the notebooks with %sql duckdb:///' + os.path.abspath(database_path))
@@ -0,0 +1,157 @@
+# Code snippet to create analysis-ready Observation, DrugIssue and Patient tables, with their lookups and dictionaries attached
+# Run as: python Step1F-Denormalize-lookups.py path-to-files metadata_version [--format csv|parquet] [--tables Observation DrugIssue Patient] [--output path]
+# E.g. python Step1F-Denormalize-lookups.py /proc-data/SYN_AURUM v2p9 --format parquet
+# User gives the directory path which should contain the 'metadata_csv' sub-directory from Step1A and the 'data_csv'
+# (or 'data_parquet') sub-directory from Step1B
+# The lookup tables (Gender, Region, JobCat, ObsType, NumUnit, QuantUnit, ...), the Medical and Product dictionaries and the
+# Practice and Staff tables are read once into an in-memory cache; then each file of the given tables is read in blocks, and
+# next to each field that maps to one of them (from the 'Mapping' of the Step1A metadata) are added the descriptions, dictionary
+# terms and SNOMED CT ids of its value, e.g. obstype_description, numunit_description, term and snomedctconceptid in Observation,
+# termfromemis, productname, drugsubstancename and bnfchapter in DrugIssue, gender_description, region and region_description
+# in Patient (the region of its practice); these columns are dictionary-encoded, each distinct description is stored once
+# The tables are written as parquet files (one per Step1B file) in a 'data_analysis' sub-directory (or --output), with the
+# column types of Step1B, which pandas reads with the added columns as categoricals (pd.read_parquet('.../data_analysis/Observation'))
+# and DuckDB as VARCHAR (Step1E --analysis creates views over them)
+# A 'manifest.json' in that directory records each file written: re-running only rewrites new or changed files (or files whose
+# output was deleted), or all of them when a lookup table, a dictionary or the options changed
+# Needs the pyarrow library
+
+## Libraries
+import os
+import argparse
+import csv
+import time
+import pyarrow.csv as pa_csv
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+import aurum_utils
+
+BLOCK_SIZE = 16 * 1024 * 1024 # bytes of csv per record batch, and parquet row group (about 150,000 rows of Observation)
+
+## Functions
+def csv_batches(csv_path, fields):
+    # record batches of a Step1B data csv file, typed from the metadata fields of its table as the parquet files are
+    with aurum_utils.open_csv(csv_path) as csv_file:
+        header = next(csv.reader(csv_file), [])
+    schema = aurum_utils.arrow_schema(header, fields)
+    with aurum_utils.open_csv(csv_path) as csv_file:
+        reader = pa_csv.open_csv(csv_file.buffer, read_options=pa_csv.ReadOptions(block_size=BLOCK_SIZE),
+                                 convert_options=pa_csv.ConvertOptions(column_types=schema, strings_can_be_null=True, null_values=['']))
+        yield from reader
+
+def parquet_batches(parquet_path, dataset_path):
+    # record batches of a file of a Step1B parquet dataset, with the pracid/year columns of its hive partition
+    dataset = ds.dataset([parquet_path], format='parquet', partitioning='hive', partition_base_dir=dataset_path)
+    yield from dataset.to_batches()
+
+def write_analysis_file(batches, out_path, fields, cache, drop_columns):
+    # writes the batches with the columns carried from the cache as a parquet file, without drop_columns (the partition
+    # columns, which are in the path), returns the number of rows; the file is only renamed to out_path once complete
+    writer = None
+    n_rows = 0
+    for batch in batches:
+        batch = aurum_utils.analysis_batch(batch, fields, cache)
+        batch = batch.drop_columns([name for name in drop_columns if name in batch.schema.names])
+        if writer is None:
+            os.makedirs(os.path.dirname(out_path), exist_ok=True)
+            writer = pq.ParquetWriter(out_path + '.tmp', batch.schema)
+        writer.write_batch(batch)
+        n_rows += batch.num_rows
+    if writer is not None:
+        writer.close()
+        os.replace(out_path + '.tmp', out_path)
+    return n_rows
+
+
+## Inputs and directories
+parser = argparse.ArgumentParser(description='Create analysis-ready tables, with the lookups and dictionaries attached, from the Step1B csv (or parquet) files')
+parser.add_argument('path', help='directory containing the metadata_csv and data_csv (or data_parquet) sub-directories')
+parser.add_argument('metadata_version', help='version suffix of the metadata csv files, e.g. v2p9')
+parser.add_argument('--format', choices=['csv', 'parquet'], default='csv', help='which Step1B output to read (default: csv)')
+parser.add_argument('--tables', nargs='+', default=['Observation', 'DrugIssue', 'Patient'], help='tables to write analysis-ready (default: Observation DrugIssue Patient)')
+parser.add_argument('--output', help='directory to write the tables to (default: path/data_analysis)')
+args = parser.parse_args()
+
+data_input_path = args.path + '/data_' + args.format
+metadata_input_path = args.path + '/metadata_csv'
+data_output_path = args.output or args.path + '/data_analysis'
+tables = {table.lower(): table for table in args.tables}
+
+## ! don't change code below
+
+# input files of the tables, by name: the data csv files, or the files of the parquet datasets (with their partition directories)
+# only files which Step1B has finished are read, when there is a manifest
+input_manifest = aurum_utils.Manifest(data_input_path + '/manifest.json')
+typed_ids = bool(input_manifest.options.get('typed_ids'))
+inputs = {}
+if args.format == 'csv':
+    for name, csv_path in aurum_utils.data_csv_files(data_input_path, input_manifest):
+        table = aurum_utils.table_name(name)
+        if table.lower() in tables:
+            inputs[table + '/' + name] = (table, csv_path, data_input_path)
+else:
+    for table in sorted(os.listdir(data_input_path)):
+        if table.lower() in tables and os.path.isdir(data_input_path + '/' + table):
+            for parquet_path in sorted(ds.dataset(data_input_path + '/' + table, format='parquet').files):
+                name = os.path.relpath(parquet_path, data_input_path)[:-len('.parquet')]
+                inputs[name] = (table, parquet_path, data_input_path + '/' + table)
+if not inputs:
+    print('No', args.format, 'files of', ', '.join(args.tables), 'found in directory specified.')
+
+# the lookups, dictionaries and reference tables are read once, and kept in memory for all the files
+# (the metadata of each table is also read once; a table without metadata is written as it is)
+started = time.perf_counter()
+cache = aurum_utils.LookupCache(data_input_path, args.format, metadata_input_path, args.metadata_version, typed_ids)
+table_fields = {}
+for table in sorted({table for table, _, _ in inputs.values()}):
+    table_fields[table] = cache.fields(table)
+    if not table_fields[table]:
+        print('No metadata for', table, '- its files are written without lookups')
+    for field in table_fields[table]:
+        lookup = aurum_utils.mapped_table(field)
+        if lookup and cache.entry(lookup) is None:
+            print(table + '.' + field['Field name'], 'maps to', lookup, 'which is not in', data_input_path, '- not attached')
+n_cached = sum(1 for entry in cache.tables.values() if entry is not None)
+cached_bytes = sum(values.nbytes for entry in cache.tables.values() if entry is not None for _, values in entry[2])
+print('lookup cache:', n_cached, 'tables |', round(cached_bytes / 1024 / 1024, 1), 'MB | seconds:', round(time.perf_counter() - started, 2))
+
+# the manifest records each file written, with the lookup files it was written with: a changed lookup rewrites everything
+os.makedirs(data_output_path, exist_ok=True)
+manifest = aurum_utils.Manifest(data_output_path + '/manifest.json')
+options = {'format': args.format, 'typed_ids': typed_ids,
+           'lookups': {os.path.relpath(path, data_input_path): sha256 for path, sha256 in sorted(cache.files.items())}}
+if manifest.files and manifest.options != options:
+    print('The lookups or the options changed since the last run into', data_output_path, '- all files are rewritten')
+    manifest.files = {}
+manifest.options = options
+for name in sorted(set(manifest.files) - set(inputs)):
+    print('not in', data_input_path, 'anymore, its output is left as is:', name)
+
+total_rows = 0
+for name, (table, input_path, base_path) in sorted(inputs.items()):
+    if manifest.is_unchanged(name, input_path):
+        sha256 = manifest.files[name]['sha256']
+    else:
+        sha256 = aurum_utils.file_sha256(input_path)
+    # a done file is rewritten if its output was deleted since (an input without rows has no output file)
+    out_path = data_output_path + '/' + name + '.parquet'
+    if manifest.check(name, input_path, sha256) == 'done':
+        if os.path.isfile(out_path) or not manifest.files[name]['rows']:
+            print('unchanged, skipping:', name)
+            continue
+        print('output missing, rewriting:', name)
+    manifest.start(name, input_path, sha256, [[0, aurum_utils.source_stat(input_path)[0]]])
+    started = time.perf_counter()
+    if args.format == 'csv':
+        batches = csv_batches(input_path, table_fields[table])
+        drop_columns = []
+    else: # the pracid=/year= directories of the file
+        batches = parquet_batches(input_path, base_path)
+        drop_columns = [part.split('=')[0] for part in os.path.dirname(os.path.relpath(input_path, base_path)).split(os.sep) if '=' in part]
+    n_rows = write_analysis_file(batches, out_path, table_fields[table], cache, drop_columns)
+    manifest.chunk_done(name, 0, n_rows)
+    manifest.file_done(name)
+    total_rows += n_rows
+    elapsed = time.perf_counter() - started
+    print('name:', name, '| rows:', n_rows, '| seconds:', round(elapsed, 2), '| rows/sec:', round(n_rows / elapsed) if elapsed > 0 else n_rows)
+print('Written', total_rows, 'rows to', data_output_path, '| peak memory:', aurum_utils.peak_rss_mb(), 'MB')
@@ -0,0 +1,1179 @@
+# Helper functions shared by the Step1 scripts (and the benchmarks)
+# Import with 'import aurum_utils' from a script in this directory
+
+## Libraries
+import os
+import re
+import csv
+import io
+import json
+import hashlib
+import gzip
+import zipfile
+import queue
+import threading
+import time
+import datetime
+from itertools import islice
+
+
+## Dates
+class DateLookup(dict):
+    # memoized conversion of CPRD dates from DD/MM/YYYY to YYYY-MM-DD
+    # there are only ~40k distinct days in an extract, so each one is parsed once and then looked up
+    # (a DD/MM/YYYY value is sliced and checked with datetime.date, anything else goes through strptime, which is much slower)
+    # values of 6 characters or fewer (empty cells) are passed through unchanged, as Step1B has always done, except
+    # blank ones which are emptied, so that they are read as NULL
+    def __missing__(self, col):
+        if len(col) == 10 and col[2] == col[5] == '/' and (col[:2] + col[3:5] + col[6:]).isdigit():
+            value = datetime.date(int(col[6:]), int(col[3:5]), int(col[:2])).isoformat()
+        elif len(col) > 6:
+            value = datetime.datetime.strptime(col, "%d/%m/%Y").strftime("%Y-%m-%d")
+        else:
+            value = col if col.strip() else ''
+        self[col] = value
+        return value
+
+def header_date_fields(header):
+    # fields == 'lcd' OR that contain 'date' as substring (can tweak later to avoid hardcoding)
+    return [idx for idx, x in enumerate(header) if ('date' in x) or (x == 'lcd')]
+
+
+## Converting rows, from the metadata types
+def row_converter(header, fields):
+    # compiles a function converting a batch of rows of a txt file in place, from the Step1A metadata types of its columns:
+    # - DATE fields from DD/MM/YYYY to YYYY-MM-DD (DateLookup), so no date column depends on its name
+    # - NUMERIC/DECIMAL fields stripped of padding
+    # - blank cells of both emptied, which COPY (csv) and record_batch (parquet) read as NULL
+    # the other columns (TEXT, INTEGER, BIGINT) are passed through without being visited
+    # the statements for the converted columns are generated as the body of one loop, rather than looping over the
+    # columns of each row; without metadata (fields empty), the date columns are guessed from the header as Step1B used to
+    types = [(find_field(fields, column) or {}).get('Type') for column in header]
+    date_fields = [j for j, field_type in enumerate(types) if field_type == 'DATE'] if fields else header_date_fields(header)
+    number_fields = [j for j, field_type in enumerate(types) if field_type in ('NUMERIC', 'DECIMAL')]
+    date = DateLookup().__getitem__ # each distinct date string is only parsed once
+
+    def convert_short(row):
+        # a row with fewer (or more) columns than the header: only convert the columns that it has
+        for j in date_fields:
+            if j < len(row):
+                row[j] = date(row[j])
+        for j in number_fields:
+            if j < len(row):
+                row[j] = row[j].strip()
+
+    if not date_fields and not number_fields:
+        return lambda data: data
+    source = ['def convert(data):', '    for row in data:', '        if len(row) == ' + str(len(header)) + ':']
+    source += ['            row[' + str(j) + '] = date(row[' + str(j) + '])' for j in date_fields]
+    source += ['            row[' + str(j) + '] = row[' + str(j) + '].strip()' for j in number_fields]
+    source += ['        else:', '            convert_short(row)', '    return data']
+    namespace = {'date': date, 'convert_short': convert_short}
+    exec(compile('\n'.join(source), '<row converter>', 'exec'), namespace)
+    return namespace['convert']
+
+
+## Reading the CPRD txt files
+# the txt files can be read where they are delivered and stored compressed: as .txt.gz or .txt.zst files (zstd needs the
+# zstandard library, only imported when used), or as the .txt members of .zip archives (e.g. the CPRD extract zip files)
+# a txt 'source' is the path of a file, or 'archive.zip::member.txt' for a member of a zip archive
+def txt_sources(path_from):
+    # {name (without the .txt extension): source} of the cprd txt files in a directory, plain or compressed
+    # a name found more than once (e.g. a zip archive next to some of its files, unpacked) is read from its plain .txt file
+    sources = {}
+    for filename in sorted(os.listdir(path_from), key=lambda x: (not x.endswith('.txt'), x)):
+        path = path_from + '/' + filename
+        if filename.endswith('.zip'):
+            with zipfile.ZipFile(path) as archive:
+                members = [member for member in archive.namelist() if member.endswith('.txt')]
+            for member in members:
+                sources.setdefault(os.path.basename(member).split('.')[0], path + '::' + member)
+        elif filename.endswith(('.txt', '.txt.gz', '.txt.zst')):
+            sources.setdefault(filename.split('.')[0], path) # this assume no period (.) in the filename
+    return sources
+
+def list_txt_files(path_from):
+    # names (without the .txt extension) of the cprd txt files in a directory
+    return sorted(txt_sources(path_from))
+
+def is_compressed(source):
+    return not source.endswith('.txt') or '::' in source
+
+def source_stat(source):
+    # size and mtime of a txt source (for a zip member: its uncompressed size and the time recorded for it in the archive)
+    if '::' in source:
+        path, member = source.split('::', 1)
+        with zipfile.ZipFile(path) as archive:
+            info = archive.getinfo(member)
+        return info.file_size, time.mktime(info.date_time + (0, 0, -1))
+    stat = os.stat(source)
+    return stat.st_size, stat.st_mtime
+
+def open_txt(source):
+    # binary file object of the (decompressed) content of a txt source
+    if '::' in source:
+        path, member = source.split('::', 1)
+        archive = zipfile.ZipFile(path)
+        return archive.open(member) # the member keeps its archive file open, and closes it with itself
+    if source.endswith('.gz'):
+        return gzip.open(source, 'rb')
+    if source.endswith('.zst'):
+        import zstandard
+        return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(open(source, 'rb'), read_across_frames=True), 1024 * 1024)
+    return open(source, 'rb')
+
+def threaded_blocks(open_stream, block_size=8 * 1024 * 1024, read_ahead=4):
+    # yields the blocks read from the stream returned by open_stream(), read (and decompressed) by a separate thread,
+    # up to read_ahead blocks ahead; zlib and zstd release the GIL while they decompress, so the decompression of the
+    # next blocks runs while the rows of the current one are parsed
+    blocks = queue.Queue(read_ahead)
+    stop = threading.Event()
+    def read():
+        try:
+            with open_stream() as stream:
+                while not stop.is_set():
+                    block = stream.read(block_size)
+                    blocks.put(block)
+                    if not block:
+                        break
+        except Exception as error:
+            blocks.put(error)
+    reader = threading.Thread(target=read, daemon=True)
+    reader.start()
+    try:
+        while True:
+            block = blocks.get()
+            if isinstance(block, Exception):
+                raise block
+            if not block:
+                break
+            yield block
+    finally: # e.g. the rows are not all read: unblock the reader thread and let it finish
+        stop.set()
+        while reader.is_alive():
+            try:
+                blocks.get_nowait()
+            except queue.Empty:
+                reader.join(0.01)
+
+def table_name(name):
+    # name of the table a txt file belongs to: big tables are delivered as numbered part files,
+    # e.g. 'Observation_001' or 'MyStudy_Extract_Observation_001' both belong to the 'Observation' table
+    # (a '__' suffix, as in the partition files written by Step1B, e.g. 'Observation_001__y2015', is dropped too)
+    name = re.sub(r'_\d+$', '', name.split('__')[0])
+    if '_Extract_' in name:
+        name = name.split('_Extract_')[-1]
+    return name
+
+def read_header(txt_path):
+    # returns the header fields of a txt file and the byte offset at which its data rows start
+    with open_txt(txt_path) as txt_file:
+        line = txt_file.readline()
+    header = next(csv.reader([line.decode('latin1')], delimiter='	', quotechar='"'), [])
+    return header, len(line)
+
+def split_byte_ranges(data_start, size, chunk_bytes):
+    # splits the data rows of a file into byte ranges [start, end) of about chunk_bytes each
+    if chunk_bytes <= 0 or size - data_start <= chunk_bytes:
+        return [(data_start, size)]
+    return [(start, min(start + chunk_bytes, size)) for start in range(data_start, size, chunk_bytes)]
+
+def txt_byte_ranges(source, data_start, chunk_bytes):
+    # byte ranges of the data rows of a txt source (split_byte_ranges); a compressed source cannot be read from
+    # the middle, so it is a single range, from the end of its header to its (compressed) size
+    return split_byte_ranges(data_start, source_stat(source)[0], 0 if is_compressed(source) else chunk_bytes)
+
+def compressed_lines(source):
+    # yields the lines (without their line break) of a compressed txt source, decompressed by a separate thread
+    rest = ''
+    for block in threaded_blocks(lambda: open_txt(source)):
+        lines = (rest + block.decode('latin1')).split('\n')
+        rest = lines.pop()
+        yield from lines
+    if rest:
+        yield rest
+
+def read_lines(txt_path, start, end):
+    # yields the lines of a txt file which start within the byte range [start, end)
+    # a chunk boundary can fall in the middle of a line: that line belongs to the chunk in which it starts
+    # (this assumes no field contains a line break, which holds for the CPRD txt files)
+    # a compressed source is a single range (txt_byte_ranges): all its lines after the header are read, whatever end is
+    if is_compressed(txt_path):
+        lines = compressed_lines(txt_path)
+        if start > 0:
+            next(lines, None) # the header
+        yield from lines
+        return
+    with open(txt_path, 'rb') as txt_file:
+        if start > 0:
+            txt_file.seek(start - 1)
+            txt_file.readline() # skip to the first line starting at or after 'start'
+        position = txt_file.tell()
+        while position < end:
+            line = txt_file.readline()
+            if not line:
+                break
+            position += len(line)
+            yield line.decode('latin1')
+
+def converted_batches(txt_path, header, start, end, batch_size, fields=(), stats=None):
+    # yields batches of at most batch_size rows (lists of fields) from the byte range [start, end) of a txt file,
+    # converted from the metadata fields of its table (row_converter), so only one batch is held in memory at a time
+    # the identifier columns typed BIGINT (typed_id_fields) are checked as the rows go, and once all the rows are read
+    # a ValueError reports the values that could not be stored as BIGINT (check_ids), so that the chunk is not recorded as done
+    # with a ChunkStats, the time spent reading, parsing, converting and (by the caller, until it asks for the next batch)
+    # writing each batch is added to it, with the rows and bytes read
+    convert = row_converter(header, fields)
+    id_fields = id_columns(header, fields)
+    invalid = {}
+    lines = read_lines(txt_path, start, end)
+    clock = time.perf_counter
+    if stats:
+        stats.start()
+    while True:
+        started = clock()
+        batch = list(islice(lines, batch_size))
+        if not batch:
+            break
+        read = clock()
+        data = list(csv.reader(batch, delimiter='\t', quotechar='"'))
+        parsed = clock()
+        if id_fields:
+            check_ids(data, id_fields, invalid)
+        data = convert(data)
+        converted = clock()
+        yield data
+        if stats:
+            stats.batch_done(len(data), sum(map(len, batch)), read - started, parsed - read, converted - parsed, clock() - converted)
+    if stats:
+        stats.done()
+    if invalid:
+        raise ValueError(os.path.basename(txt_path.split('::')[-1]) + ': values that cannot be stored as BIGINT - '
+                         + '; '.join(header[j] + ': ' + str(n) + ' (e.g. ' + ', '.join(repr(v) for v in values) + ')' for j, (n, values) in sorted(invalid.items())))
+
+class CsvStream(io.TextIOBase):
+    # read-only file-like object serving batches of rows as csv text, e.g. for psycopg2's copy_expert (COPY ... FROM STDIN)
+    # only the csv text of the current batch is held in memory
+    def __init__(self, batches):
+        self.batches = iter(batches)
+        self.current = io.StringIO()
+        self.n_rows = 0
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        out = self.current.read(size)
+        while size < 0 or len(out) < size:
+            data = next(self.batches, None)
+            if data is None:
+                break
+            self.current = io.StringIO()
+            csv.writer(self.current, delimiter=',').writerows(data)
+            self.current.seek(0)
+            self.n_rows += len(data)
+            out += self.current.read(size - len(out) if size >= 0 else -1)
+        return out
+
+
+## Data csv files, plain or compressed
+# Step1B can write its csv files compressed, as .csv.gz (gzip) or .csv.zst (zstd, needs the zstandard library); the part files of
+# a chunked conversion are compressed separately and concatenated, which makes a valid gzip or zstd file
+CSV_EXTENSIONS = {None: '.csv', 'gzip': '.csv.gz', 'zstd': '.csv.zst'}
+
+def data_csv_name(filename):
+    # name of a Step1B data csv file without its extension (e.g. 'Observation_001' for Observation_001.csv.gz), or None
+    for extension in CSV_EXTENSIONS.values():
+        if filename.endswith(extension):
+            return filename[:-len(extension)]
+    return None
+
+def data_csv_files(data_path, manifest):
+    # [(name, path)] of the data csv files in data_path, plain or compressed (only files which Step1B has finished, when
+    # there is a manifest), sorted by name
+    files = []
+    for filename in sorted(os.listdir(data_path)):
+        name = data_csv_name(filename)
+        if name and (not manifest.files or manifest.files.get(name.split('__')[0], {}).get('status') == 'done'):
+            files.append((name, data_path + '/' + filename))
+    return files
+
+def open_csv(path, mode='r', extension=None):
+    # text file object reading (mode 'r', for the csv module) or writing/appending (mode 'w'/'a') a data csv file,
+    # compressed or not according to its extension (or to 'extension', for the part file of a chunk);
+    # gzip at level 6 and zstd at level 3, their command-line defaults
+    newline = '' if mode == 'r' else None
+    extension = extension or path
+    if extension.endswith('.gz'):
+        return gzip.open(path, mode + 't', compresslevel=6, newline=newline)
+    if extension.endswith('.zst'):
+        import zstandard
+        if mode == 'r':
+            stream = io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), read_across_frames=True), 1024 * 1024)
+        else:
+            stream = zstandard.ZstdCompressor(level=3).stream_writer(open(path, mode + 'b'))
+        return io.TextIOWrapper(stream, newline=newline)
+    return open(path, mode, newline=newline)
+
+def decompress_program(path):
+    # shell command writing the content of a data csv file to stdout, for PostgreSQL's COPY ... FROM PROGRAM
+    return ('gzip -dc' if path.endswith('.gz') else 'zstd -dcq') + ' "' + path + '"'
+
+
+## Instrumentation
+# the cost of each chunk converted by Step1B (rows, bytes, seconds per stage, peak memory of its process), live progress,
+# and the json run report
+STAGES = ['read', 'parse', 'convert', 'write']
+
+def peak_rss_mb(who='self'):
+    # peak resident memory of this process ('self') or of its finished child processes ('children') so far, in MB
+    # (None where the resource module does not exist, i.e. on Windows)
+    try:
+        import resource
+    except ImportError:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_SELF if who == 'self' else resource.RUSAGE_CHILDREN)
+    return round(usage.ru_maxrss / 1024, 1) # ru_maxrss is in KB on Linux
+
+def format_seconds(seconds):
+    return str(datetime.timedelta(seconds=round(seconds)))
+
+class ChunkStats:
+    # what converting a chunk (or a whole file) cost, filled in by converted_batches and the chunk functions of Step1B
+    # it is created with the task and sent to the worker process, which returns it filled in
+    # with progress_seconds, a progress line is printed by the worker every progress_seconds while the chunk is converted
+    def __init__(self, name, chunk, bytes_read, compressed=False, progress_seconds=0):
+        self.name, self.chunk = name, chunk
+        self.bytes_read = bytes_read # for a compressed file, its compressed size
+        self.compressed = compressed
+        self.progress_seconds = progress_seconds
+        self.rows = 0
+        self.text_bytes = 0
+        self.bytes_written = 0
+        self.seconds = 0.0
+        self.stages = dict.fromkeys(STAGES, 0.0)
+        self.peak_rss_mb = None
+        self.pid = None
+
+    def start(self):
+        self.started = self.last_progress = time.perf_counter()
+        self.pid = os.getpid()
+
+    def batch_done(self, n_rows, n_bytes, *stage_seconds):
+        self.rows += n_rows
+        self.text_bytes += n_bytes
+        for stage, seconds in zip(STAGES, stage_seconds):
+            self.stages[stage] += seconds
+        now = time.perf_counter()
+        if self.progress_seconds and now - self.last_progress >= self.progress_seconds:
+            self.last_progress = now
+            elapsed = now - self.started
+            line = '  ' + self.name + ' chunk ' + str(self.chunk) + ': ' + str(self.rows) + ' rows'
+            if not self.compressed and self.bytes_read:
+                done = self.text_bytes / self.bytes_read
+                line += ' | ' + str(round(100 * done)) + '%' + (' | ETA ' + format_seconds(elapsed * (1 - done) / done) if done else '')
+            print(line, '| rows/sec:', round(self.rows / elapsed) if elapsed > 0 else self.rows, flush=True)
+
+    def done(self):
+        # called by converted_batches after the last batch, then by the chunk function once its files are closed:
+        # the time in between (e.g. flushing compressed or parquet files) counts as writing
+        seconds = time.perf_counter() - self.started
+        if self.seconds:
+            self.stages['write'] += seconds - self.seconds
+        self.seconds = seconds
+        self.peak_rss_mb = peak_rss_mb()
+
+    def as_dict(self):
+        return {'rows': self.rows, 'seconds': round(self.seconds, 3), 'bytes_read': self.bytes_read, 'bytes_written': self.bytes_written,
+                'stages': {stage: round(seconds, 3) for stage, seconds in self.stages.items()}, 'peak_rss_mb': self.peak_rss_mb, 'pid': self.pid}
+
+class RunReport:
+    # the statistics of a Step1B run: collects the ChunkStats of each chunk as it is done, prints the overall progress
+    # (at most every progress_seconds) with an ETA from the bytes left to convert, and writes the json run report
+    def __init__(self, path, total_bytes, options, progress_seconds=0):
+        self.path = path
+        self.total_bytes = total_bytes
+        self.options = options
+        self.progress_seconds = progress_seconds
+        self.files = {}
+        self.bytes_done = 0
+        self.started = self.last_progress = time.perf_counter()
+        self.start_time = datetime.datetime.now().isoformat(timespec='seconds')
+
+    def chunk_done(self, stats):
+        entry = self.files.setdefault(stats.name, {'table': table_name(stats.name), 'chunks': {}})
+        entry['chunks'][stats.chunk] = stats.as_dict()
+        self.bytes_done += stats.bytes_read
+        now = time.perf_counter()
+        if self.progress_seconds and (now - self.last_progress >= self.progress_seconds or self.bytes_done >= self.total_bytes):
+            self.last_progress = now
+            elapsed = now - self.started
+            line = 'progress: ' + str(round(self.bytes_done / 1e6, 1)) + ' of ' + str(round(self.total_bytes / 1e6, 1)) + ' MB'
+            if elapsed > 0 and self.bytes_done:
+                line += (' | MB/sec: ' + str(round(self.bytes_done / elapsed / 1e6, 1))
+                         + ' | elapsed ' + format_seconds(elapsed) + ' | ETA ' + format_seconds(elapsed * max(self.total_bytes - self.bytes_done, 0) / self.bytes_done))
+            print(line, flush=True)
+
+    def summary(self, chunks):
+        # rows, bytes, seconds and seconds per stage summed over chunks, and the highest peak memory of their processes
+        summary = {'rows': sum(c['rows'] for c in chunks), 'seconds': round(sum(c['seconds'] for c in chunks), 3),
+                   'bytes_read': sum(c['bytes_read'] for c in chunks), 'bytes_written': sum(c['bytes_written'] for c in chunks),
+                   'stages': {stage: round(sum(c['stages'][stage] for c in chunks), 3) for stage in STAGES}}
+        summary['peak_rss_mb'] = max((c['peak_rss_mb'] for c in chunks if c['peak_rss_mb'] is not None), default=None)
+        return summary
+
+    def report(self):
+        files = {name: dict(self.summary(list(entry['chunks'].values())), **entry) for name, entry in sorted(self.files.items())}
+        tables = {}
+        for name, entry in self.files.items():
+            tables.setdefault(entry['table'], []).extend(entry['chunks'].values())
+        run = self.summary([c for entry in self.files.values() for c in entry['chunks'].values()])
+        run['worker_seconds'] = run.pop('seconds') # summed over the chunks, so over the workers
+        run['seconds'] = round(time.perf_counter() - self.started, 3)
+        run['peak_rss_mb'] = max([x for x in [run['peak_rss_mb'], peak_rss_mb(), peak_rss_mb('children')] if x is not None], default=None)
+        return dict(run, started=self.start_time, options=self.options,
+                    tables={table: self.summary(chunks) for table, chunks in sorted(tables.items())}, files=files)
+
+    def save(self):
+        # a run that converted nothing leaves the report of the previous run as it is
+        report = self.report()
+        if self.files:
+            with open(self.path, 'w') as f:
+                json.dump(report, f, indent=1)
+        return report
+
+
+## Manifest of converted/loaded files
+def file_sha256(path):
+    # content hash of a file, read in blocks so that memory use stays flat
+    # (of the compressed bytes for a compressed txt file; for a member of a zip archive, its CRC-32 and size from the
+    # archive directory stand in for it, so the archive is not read)
+    if '::' in path:
+        archive_path, member = path.split('::', 1)
+        with zipfile.ZipFile(archive_path) as archive:
+            info = archive.getinfo(member)
+        return 'crc32:' + format(info.CRC, '08x') + ':' + str(info.file_size)
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(16 * 1024 * 1024), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+class Manifest:
+    # json record of the size, mtime and content hash of each input file, and of how far its processing got,
+    # so that a re-run only redoes new or changed files and resumes a half-finished run from the last completed chunk
+    # files[name] = {'size', 'mtime', 'sha256', 'status' ('in progress' or 'done'), 'byte_ranges', 'chunks_done', 'rows'}
+    def __init__(self, path):
+        self.path = path
+        self.options = {}
+        self.files = {}
+        if os.path.isfile(path):
+            with open(path) as f:
+                saved = json.load(f)
+            self.options = saved.get('options', {})
+            self.files = saved.get('files', {})
+
+    def save(self):
+        # written to a temporary file first, so a crash never leaves a half-written manifest
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump({'options': self.options, 'files': self.files}, f, indent=1, sort_keys=True)
+        os.replace(self.path + '.tmp', self.path)
+
+    def is_unchanged(self, name, path):
+        # True if the file has the same size and mtime as recorded, i.e. its recorded hash can be trusted without rehashing
+        entry = self.files.get(name)
+        size, mtime = source_stat(path)
+        return entry is not None and entry['size'] == size and entry['mtime'] == mtime
+
+    def check(self, name, path, sha256):
+        # compares a file with its record: returns 'done', 'resume' (same content, not finished) or 'new' (new or changed file)
+        # the size and mtime of the record are refreshed, e.g. after a file was copied without changing its content
+        entry = self.files.get(name)
+        if entry is None or entry['sha256'] != sha256:
+            return 'new'
+        entry['size'], entry['mtime'] = source_stat(path)
+        return 'done' if entry['status'] == 'done' else 'resume'
+
+    def start(self, name, path, sha256, byte_ranges):
+        # (re)starts the record of a new or changed file
+        size, mtime = source_stat(path)
+        self.files[name] = {'size': size, 'mtime': mtime, 'sha256': sha256, 'status': 'in progress',
+                            'byte_ranges': byte_ranges, 'chunks_done': [], 'rows': 0}
+
+    def chunk_done(self, name, k, n_rows):
+        # records a completed chunk, returns True once all chunks of the file are done
+        entry = self.files[name]
+        entry['chunks_done'] = sorted(set(entry['chunks_done']) | {k})
+        entry['rows'] += n_rows
+        return len(entry['chunks_done']) == len(entry['byte_ranges'])
+
+    def file_done(self, name):
+        self.files[name]['status'] = 'done'
+        self.save()
+
+
+# the files (and chunks of files) loaded into PostgreSQL, recorded in the same transaction as their COPY by Step1D and by the
+# Step1C load plan, so that what was recorded as loaded is what was committed, whatever happened to the run
+LOAD_LOG_SQL = 'CREATE TABLE IF NOT EXISTS aurum_load_log (table_name TEXT, name TEXT, sha256 TEXT, chunk INT, n_rows BIGINT, PRIMARY KEY (name, sha256, chunk))'
+
+
+## Metadata from Step1A
+def metadata_file(metadata_path, name, metadata_version):
+    # path of the Step1A metadata csv of a table, matching the table name case-insensitively (e.g. Common_Dosages)
+    wanted = (name + '-' + metadata_version + '.csv').lower()
+    for filename in os.listdir(metadata_path):
+        if filename.lower() == wanted:
+            return os.path.join(metadata_path, filename)
+    raise FileNotFoundError('No metadata csv for table ' + name + ' (' + metadata_version + ') in ' + metadata_path)
+
+def read_metadata(metadata_path, name, metadata_version):
+    # list of dicts, one per field, with at least the keys 'Field name' and 'Type'
+    # the dictionary tables give the field name in 'Column name', the other tables in 'Field name'
+    with open(metadata_file(metadata_path, name, metadata_version), newline='') as csv_file:
+        fields = list(csv.DictReader(csv_file))
+    for field in fields:
+        if 'Field name' not in field:
+            field['Field name'] = field['Column name']
+    return fields
+
+def sql_type(field):
+    # postgresql data type of a metadata field
+    return 'INT' if field['Type'] == 'INTEGER' else field['Type']
+
+def create_table_sql(name, fields, unlogged=False, partitioning=None):
+    # DROP and CREATE TABLE statements for a table, typed from its metadata
+    # an UNLOGGED table skips the write-ahead log, which makes the bulk load faster (see finalise_table_sql)
+    columns = ' (' + ', '.join(f['Field name'] + ' ' + sql_type(f) for f in fields) + ')'
+    sql = 'DROP TABLE IF EXISTS ' + name + ';\n'
+    if partitioning is None or not partitioning.applies_to(name):
+        return sql + 'CREATE ' + ('UNLOGGED ' if unlogged else '') + 'TABLE ' + name + columns + ';\n'
+    # a partitioned table holds no data itself, only its partitions can be UNLOGGED
+    sql += 'CREATE TABLE ' + name + columns + ' PARTITION BY ' + partitioning.method + ' (' + partitioning.key_field(fields) + ');\n'
+    for suffix, bounds in partitioning.partitions():
+        sql += 'CREATE ' + ('UNLOGGED ' if unlogged else '') + 'TABLE ' + name + '_' + suffix + ' PARTITION OF ' + name + ' ' + bounds + ';\n'
+    return sql
+
+def primary_key_fields(fields):
+    # fields described as 'the primary key for this table' in the metadata
+    return [f['Field name'] for f in fields if 'primary key' in f.get('Description', '')]
+
+def linked_fields(fields):
+    # fields that join to another patient or event table ('Link ... table') or to the medical/product dictionary,
+    # which are worth a btree index; links to the small Practice and Staff tables are left out
+    linked = []
+    for f in fields:
+        mapping = f.get('Mapping', '')
+        if (mapping.startswith('Link') and 'Practice' not in mapping and 'Staff' not in mapping) or 'dictionary' in mapping.lower():
+            if f['Field name'] not in primary_key_fields(fields):
+                linked.append(f['Field name'])
+    return linked
+
+def finalise_table_sql(name, fields, partitioning=None):
+    # statements to run once a table is loaded: SET LOGGED first (it rewrites the table and rebuilds its indexes, so any
+    # index built before it would be built twice and written to the WAL), then the primary key, btree indexes on the linked
+    # fields, BRIN indexes on the date fields (small, and good at skipping blocks for date ranges), and ANALYZE
+    # on a partitioned table, the indexes are created on each partition and the primary key has to include the partition key:
+    # with patid partitions it becomes (key, patid), with year partitions (where the event date can be empty) a plain index
+    sql = ''
+    primary_key = primary_key_fields(fields)
+    partitioned = partitioning is not None and partitioning.applies_to(name)
+    if partitioned:
+        for suffix, bounds in partitioning.partitions():
+            sql += 'ALTER TABLE ' + name + '_' + suffix + ' SET LOGGED;\n'
+    else:
+        sql += 'ALTER TABLE ' + name + ' SET LOGGED;\n'
+    if primary_key and partitioned and partitioning.by == 'year':
+        sql += 'CREATE INDEX IF NOT EXISTS ' + name.lower() + '_' + '_'.join(primary_key) + '_idx ON ' + name + ' (' + ', '.join(primary_key) + ');\n'
+    elif primary_key:
+        if partitioned and partitioning.key_field(fields) not in primary_key:
+            primary_key = primary_key + [partitioning.key_field(fields)]
+        sql += 'ALTER TABLE ' + name + ' ADD PRIMARY KEY (' + ', '.join(primary_key) + ');\n'
+    for field in linked_fields(fields):
+        sql += 'CREATE INDEX IF NOT EXISTS ' + name.lower() + '_' + field + '_idx ON ' + name + ' (' + field + ');\n'
+    for field in [f['Field name'] for f in fields if f['Type'] == 'DATE']:
+        sql += 'CREATE INDEX IF NOT EXISTS ' + name.lower() + '_' + field + '_brin ON ' + name + ' USING BRIN (' + field + ');\n'
+    sql += 'ANALYZE ' + name + ';\n'
+    return sql
+
+# whether a table, or any of its partitions, is still UNLOGGED (i.e. not finalised); NULL if there is no such table
+UNLOGGED_SQL = "SELECT bool_or(relpersistence = 'u') FROM pg_class WHERE oid = to_regclass(%(table)s) OR oid IN (SELECT inhrelid FROM pg_inherits WHERE inhparent = to_regclass(%(table)s))"
+
+
+def find_field(fields, field_name):
+    # metadata of the field called field_name (case-insensitive), or None
+    for field in fields:
+        if field['Field name'].lower() == field_name.lower():
+            return field
+    return None
+
+def event_date_field(fields):
+    # name of the 'Event date' field of a table (obsdate, issuedate, consdate), or None
+    for field in fields:
+        if field.get('Column name') == 'Event date' and field['Type'] == 'DATE':
+            return field['Field name']
+    return None
+
+
+## Typed identifiers
+# the CPRD identifiers and codes (patid, obsid, consid, medcodeid, prodcodeid, staffid, ...) are TEXT in the metadata, but are
+# numeric only ('Up to 19 numeric characters'), so they can be stored as BIGINT (int64): half the size, and faster to join and index
+# a value is only written as BIGINT if it reads back unchanged: digits only, no leading zero, at most 2**63-1
+BIGINT_MAX = 2**63 - 1
+
+def is_id_field(field):
+    # numeric identifier field, except the codes of lookup txt files (e.g. conssourceid), as the lookup tables stay TEXT
+    return (field['Type'] == 'TEXT' and 'numeric characters' in (field.get('Format') or '')
+            and not re.match(r'Lookup: .*\.txt', field.get('Mapping') or ''))
+
+def typed_id_fields(fields):
+    # copy of the metadata fields, with the numeric identifier fields typed BIGINT instead of TEXT
+    return [dict(field, Type='BIGINT') if is_id_field(field) else field for field in fields]
+
+def id_columns(header, fields):
+    # positions of the BIGINT fields in a txt file header
+    return [j for j, column in enumerate(header) if (find_field(fields, column) or {}).get('Type') == 'BIGINT']
+
+def is_bigint(value):
+    # whether a non-empty identifier can be stored as a BIGINT and read back unchanged
+    return (value.isdecimal() and value.isascii() and (value[0] != '0' or value == '0')
+            and (len(value) < 19 or (len(value) == 19 and int(value) <= BIGINT_MAX)))
+
+def check_ids(data, id_fields, invalid):
+    # checks the identifier columns id_fields of a batch of rows, adding the values that cannot be stored as BIGINT
+    # to invalid ({column position: [number of values, first 10 values]}); empty values are NULL, which is fine
+    # the invalid values are blanked, so that the rest of the rows can still be converted (and checked) before they are reported
+    for j in id_fields:
+        for row in data:
+            if j < len(row) and row[j] and not is_bigint(row[j]):
+                found = invalid.setdefault(j, [0, []])
+                found[0] += 1
+                if len(found[1]) < 10:
+                    found[1].append(row[j])
+                row[j] = ''
+    return data
+
+
+## Patient follow-up summary
+# one row per patient with what cohort eligibility and the Step2B statistics need, so that they do not have to be worked out
+# from Patient and Practice at every query; follow-up is defined as in the Step2B notebook: from the registration start date,
+# or the start of follow-up (1995-01-01) if later, to the registration end date, or the release date of the data if still registered
+PATIENT_SUMMARY_COLUMNS = [('patid', 'TEXT'), ('pracid', 'INT'), ('acceptable', 'INT'), ('regstartdate', 'DATE'), ('regenddate', 'DATE'),
+                           ('cprd_ddate', 'DATE'), ('followup_start', 'DATE'), ('followup_end', 'DATE'), ('followup_days', 'INT'),
+                           ('lcd', 'DATE'), ('region', 'INT')]
+
+def patient_summary_select_sql(release_date, followup_start):
+    # SELECT of the PatientSummary rows from the Patient and Practice tables (runs on PostgreSQL and DuckDB)
+    start = "CASE WHEN p.regstartdate < DATE '" + followup_start + "' THEN DATE '" + followup_start + "' ELSE p.regstartdate END"
+    end = "COALESCE(p.regenddate, DATE '" + release_date + "')"
+    return ('SELECT p.patid, p.pracid, p.acceptable, p.regstartdate, p.regenddate, p.cprd_ddate, ' + start + ' AS followup_start, '
+            + end + ' AS followup_end, ' + end + ' - ' + start + ' AS followup_days, pr.lcd, pr.region\n'
+            'FROM Patient p LEFT JOIN Practice pr ON pr.pracid = p.pracid')
+
+def patient_summary_sql(release_date='2021-10-01', followup_start='1995-01-01', typed_ids=False):
+    # statements to create the PatientSummary table, or refresh it once Patient or Practice have been (re)loaded:
+    # only the rows of new or changed patients are written, and the rows of patients no longer in Patient are deleted
+    # (with typed_ids, patid is a BIGINT as in Patient; a table left with the other patid type is dropped and re-created)
+    columns = [column for column, _ in PATIENT_SUMMARY_COLUMNS[1:]]
+    column_types = [('patid', 'BIGINT' if typed_ids else 'TEXT')] + PATIENT_SUMMARY_COLUMNS[1:]
+    sql = ("DO $$ BEGIN IF EXISTS (SELECT 1 FROM pg_attribute WHERE attrelid = to_regclass('patientsummary') AND attname = 'patid' "
+           "AND atttypid <> '" + column_types[0][1].lower() + "'::regtype) THEN DROP TABLE PatientSummary; END IF; END $$;\n")
+    sql += 'CREATE TABLE IF NOT EXISTS PatientSummary (' + ', '.join(column + ' ' + column_type for column, column_type in column_types) + ', PRIMARY KEY (patid));\n'
+    sql += 'INSERT INTO PatientSummary\n' + patient_summary_select_sql(release_date, followup_start) + '\n'
+    sql += 'ON CONFLICT (patid) DO UPDATE SET ' + ', '.join(column + ' = EXCLUDED.' + column for column in columns) + '\n'
+    sql += 'WHERE (' + ', '.join('PatientSummary.' + column for column in columns) + ') IS DISTINCT FROM (' + ', '.join('EXCLUDED.' + column for column in columns) + ');\n'
+    sql += 'DELETE FROM PatientSummary s WHERE NOT EXISTS (SELECT 1 FROM Patient p WHERE p.patid = s.patid);\n'
+    sql += 'CREATE INDEX IF NOT EXISTS patientsummary_pracid_idx ON PatientSummary (pracid);\n'
+    sql += 'CREATE INDEX IF NOT EXISTS patientsummary_eligibility_idx ON PatientSummary (acceptable, followup_start, followup_end);\n'
+    sql += 'ANALYZE PatientSummary;\n'
+    return sql
+
+
+## Partitioned tables
+PARTITIONED_TABLES = ('Observation', 'DrugIssue') # the big event tables, worth partitioning
+
+# PostgreSQL routes a row of a hash-partitioned table from the hash of its key: Bob Jenkins' lookup3 hash of the bytes for
+# TEXT (hashtextextended), of the 64-bit integer folded to 32 bits for BIGINT (hashint8extended), seeded with the partition
+# seed, combined with 0 and taken modulo the number of partitions (src/common/hashfn.c, src/backend/partitioning/partbounds.c)
+# It is reproduced here so that the patid shards of Step1B hold the same patients as the partitions of Step1C/Step1D
+HASH_PARTITION_SEED = 0x7A5B22367996DCFD
+MASK32 = 0xFFFFFFFF
+MASK64 = 0xFFFFFFFFFFFFFFFF
+
+def rot32(x, k):
+    return ((x << k) | (x >> (32 - k))) & MASK32
+
+def lookup3_mix(a, b, c):
+    a = ((a - c) & MASK32) ^ rot32(c, 4); c = (c + b) & MASK32
+    b = ((b - a) & MASK32) ^ rot32(a, 6); a = (a + c) & MASK32
+    c = ((c - b) & MASK32) ^ rot32(b, 8); b = (b + a) & MASK32
+    a = ((a - c) & MASK32) ^ rot32(c, 16); c = (c + b) & MASK32
+    b = ((b - a) & MASK32) ^ rot32(a, 19); a = (a + c) & MASK32
+    c = ((c - b) & MASK32) ^ rot32(b, 4); b = (b + a) & MASK32
+    return a, b, c
+
+def lookup3_final(a, b, c):
+    c = ((c ^ b) - rot32(b, 14)) & MASK32
+    a = ((a ^ c) - rot32(c, 11)) & MASK32
+    b = ((b ^ a) - rot32(a, 25)) & MASK32
+    c = ((c ^ b) - rot32(b, 16)) & MASK32
+    a = ((a ^ c) - rot32(c, 4)) & MASK32
+    b = ((b ^ a) - rot32(a, 14)) & MASK32
+    c = ((c ^ b) - rot32(b, 24)) & MASK32
+    return a, b, c
+
+def lookup3_start(length, seed):
+    # initial state of the seeded lookup3 hash of length bytes
+    a = b = c = (0x9e3779b9 + length + 3923095) & MASK32
+    return lookup3_mix((a + (seed >> 32)) & MASK32, (b + (seed & MASK32)) & MASK32, c)
+
+def pg_hash_bytes(data, seed=HASH_PARTITION_SEED):
+    # hash_bytes_extended: the 64-bit lookup3 hash of a byte string, read as little-endian 32-bit words
+    a, b, c = lookup3_start(len(data), seed)
+    end = len(data) - len(data) % 12
+    for k in range(0, end, 12):
+        a, b, c = lookup3_mix((a + int.from_bytes(data[k:k + 4], 'little')) & MASK32,
+                              (b + int.from_bytes(data[k + 4:k + 8], 'little')) & MASK32,
+                              (c + int.from_bytes(data[k + 8:k + 12], 'little')) & MASK32)
+    rest = data[end:] + bytes(12 - len(data[end:]))
+    # the first byte of c is left for the length, so the last bytes go in its upper 24 bits
+    a = (a + int.from_bytes(rest[0:4], 'little')) & MASK32
+    b = (b + int.from_bytes(rest[4:8], 'little')) & MASK32
+    c = (c + (int.from_bytes(rest[8:11], 'little') << 8)) & MASK32
+    a, b, c = lookup3_final(a, b, c)
+    return (b << 32) | c
+
+def pg_hash_int8(value, seed=HASH_PARTITION_SEED):
+    # hashint8extended: the 64-bit integer folded to 32 bits (as int4 values hash the same), then hash_uint32_extended
+    lohalf = value & MASK32
+    hihalf = (value >> 32) & MASK32
+    lohalf ^= hihalf if value >= 0 else ~hihalf & MASK32
+    a, b, c = lookup3_start(4, seed)
+    a, b, c = lookup3_final((a + lohalf) & MASK32, b, c)
+    return (b << 32) | c
+
+def pg_hash_remainder(value, modulus, bigint=False):
+    # remainder of the hash partition PostgreSQL routes a csv value of the key to (an empty value is NULL, which hashes to 0)
+    if value == '':
+        return 0
+    row_hash = pg_hash_int8(int(value)) if bigint else pg_hash_bytes(value.encode())
+    return ((row_hash + 0x49a0f4dd15e5a8e3) & MASK64) % modulus # hash_combine64(0, hash)
+
+class Partitioning:
+    # how the big event tables are split into partitions, shared by Step1B (which can pre-split its csv files to match),
+    # Step1C and Step1D:
+    # - by='patid': hash partitions on patid, e.g. Observation_p00 ... Observation_p15 for n_partitions=16
+    # - by='year': one range partition per year of the event date (obsdate, issuedate) from first_year to last_year,
+    #   e.g. Observation_y2015, plus Observation_ybefore for earlier dates and Observation_default for empty or later dates
+    # The patid shards written by Step1B are cut with PostgreSQL's own hash (pg_hash_remainder), so that, as the year files,
+    # each can be copied straight into its partition
+    def __init__(self, by, n_partitions=16, first_year=1990, last_year=2022):
+        self.by = by
+        self.method = 'HASH' if by == 'patid' else 'RANGE'
+        self.n_partitions = n_partitions
+        self.first_year = first_year
+        self.last_year = last_year
+
+    def options(self):
+        # the settings, as recorded in the manifests
+        return {'by': self.by, 'n_partitions': self.n_partitions, 'first_year': self.first_year, 'last_year': self.last_year}
+
+    def applies_to(self, table):
+        return table_name(table) in PARTITIONED_TABLES
+
+    def key_field(self, fields):
+        return 'patid' if self.by == 'patid' else event_date_field(fields)
+
+    def suffixes(self):
+        if self.by == 'patid':
+            return ['p' + str(k).zfill(2) for k in range(self.n_partitions)]
+        return ['ybefore'] + ['y' + str(year) for year in range(self.first_year, self.last_year + 1)] + ['default']
+
+    def partitions(self):
+        # (suffix, bounds) of each partition, the bounds as in CREATE TABLE ... PARTITION OF
+        if self.by == 'patid':
+            return [(suffix, 'FOR VALUES WITH (MODULUS ' + str(self.n_partitions) + ', REMAINDER ' + str(k) + ')') for k, suffix in enumerate(self.suffixes())]
+        partitions = [('ybefore', "FOR VALUES FROM (MINVALUE) TO ('" + str(self.first_year) + "-01-01')")]
+        for year in range(self.first_year, self.last_year + 1):
+            partitions.append(('y' + str(year), "FOR VALUES FROM ('" + str(year) + "-01-01') TO ('" + str(year + 1) + "-01-01')"))
+        return partitions + [('default', 'DEFAULT')]
+
+    def suffix_of(self, value, bigint=False):
+        # partition of a key value, a patid (hashed as a BIGINT with typed identifiers, else as TEXT) or a converted
+        # (YYYY-MM-DD) event date
+        if self.by == 'patid':
+            return 'p' + str(pg_hash_remainder(value, self.n_partitions, bigint)).zfill(2)
+        if len(value) < 4:
+            return 'default'
+        year = int(value[:4])
+        if year < self.first_year:
+            return 'ybefore'
+        return 'y' + str(year) if year <= self.last_year else 'default'
+
+    def copy_target(self, table, suffix):
+        # table to COPY a pre-split csv file into: its own partition, or the parent table for an unknown suffix
+        if self.applies_to(table) and suffix in self.suffixes():
+            return table + '_' + suffix
+        return table
+
+def parse_partitioning(partition_by, n_partitions, years):
+    # Partitioning from the --partition-by, --partitions and --years (e.g. '1990-2022') command line options, or None
+    if partition_by not in ('patid', 'year'):
+        return None
+    first_year, last_year = (int(year) for year in years.split('-'))
+    return Partitioning(partition_by, n_partitions, first_year, last_year)
+
+## Parquet (needs the pyarrow library, only imported when used)
+def arrow_type(field):
+    # pyarrow data type of a metadata field: TEXT as string, DATE as date32, NUMERIC/DECIMAL p.s as decimal, INTEGER as int32,
+    # BIGINT (typed identifiers) as int64
+    import pyarrow as pa
+    if field is None or field['Type'] == 'TEXT':
+        return pa.string()
+    if field['Type'] == 'DATE':
+        return pa.date32()
+    if field['Type'] == 'INTEGER':
+        return pa.int32()
+    if field['Type'] == 'BIGINT':
+        return pa.int64()
+    if field['Type'] in ('NUMERIC', 'DECIMAL'):
+        precision_scale = re.match(r'\s*(\d+)\.(\d+)', field.get('Format', ''))
+        if precision_scale:
+            return pa.decimal128(int(precision_scale.group(1)), int(precision_scale.group(2)))
+        return pa.float64()
+    return pa.string()
+
+def arrow_schema(header, fields):
+    # pyarrow schema for the columns of a txt file, typed from the metadata fields (columns without metadata are strings)
+    import pyarrow as pa
+    return pa.schema([(column, arrow_type(find_field(fields, column))) for column in header])
+
+def record_batch(data, schema):
+    # converts a batch of converted rows (lists of strings, dates as YYYY-MM-DD) to a pyarrow RecordBatch
+    # empty strings become nulls, and each column is cast to its type from the schema
+    import pyarrow as pa
+    columns = []
+    for j, arrow_field in enumerate(schema):
+        values = pa.array([row[j] if j < len(row) and row[j] != '' else None for row in data], pa.string())
+        columns.append(values.cast(arrow_field.type))
+    return pa.RecordBatch.from_arrays(columns, schema=schema)
+
+def with_year_column(batch, date_field):
+    # adds a 'year' column (year of date_field) to a RecordBatch, to partition on
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    year = pc.year(batch.column(date_field)).cast(pa.int16())
+    return pa.RecordBatch.from_arrays(batch.columns + [year], names=batch.schema.names + ['year'])
+
+
+## Columnar reading (needs the pyarrow library, only imported when used)
+# an alternative to converted_batches for Step1B --engine arrow: the byte range of a txt file is memory-mapped and split into
+# columns by pyarrow's csv reader, in blocks of block_size bytes, and the columns are converted by pyarrow compute functions,
+# so no Python object is made per row or per field; the batches are record batches of strings, empty cells as nulls
+# (the same values as converted_batches, in columns); a row with more or fewer columns than the header raises pyarrow.ArrowInvalid
+# blocks of 1 MB (about 10,000 rows of Observation) were the fastest: the streaming reader holds many blocks at a time, and
+# bigger blocks were slower and used more memory
+ARROW_BLOCK_SIZE = 1024 * 1024
+BIGINT_PATTERN = r'^(0|[1-9][0-9]{0,18})$' # is_bigint, but for the values of 19 digits, which are also compared to BIGINT_MAX
+
+def line_range(txt_path, start, end):
+    # the byte range [start, end) moved to the first lines starting at or after start and end, as read_lines reads it
+    with open(txt_path, 'rb') as txt_file:
+        positions = []
+        for position in (start, end):
+            if position > 0:
+                txt_file.seek(position - 1)
+                txt_file.readline()
+                position = txt_file.tell()
+            positions.append(position)
+    return positions
+
+def arrow_converter(header, fields):
+    # function converting a record batch of strings read from a txt file, column by column, as row_converter converts rows,
+    # and checking the BIGINT identifier columns as check_ids (invalid values are nulled and added to the invalid dict)
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    types = [(find_field(fields, column) or {}).get('Type') for column in header]
+    date_fields = [j for j, field_type in enumerate(types) if field_type == 'DATE'] if fields else header_date_fields(header)
+    number_fields = [j for j, field_type in enumerate(types) if field_type in ('NUMERIC', 'DECIMAL')]
+    id_fields = id_columns(header, fields)
+    null = pa.scalar(None, pa.string())
+
+    def convert(batch, invalid):
+        columns = batch.columns
+        for j in date_fields: # as DateLookup: DD/MM/YYYY values (longer than 6 characters) to YYYY-MM-DD, blank ones to null
+            column = columns[j]
+            long = pc.greater(pc.utf8_length(column), 6)
+            dates = pc.strptime(pc.if_else(long, column, null), format='%d/%m/%Y', unit='s', error_is_null=False)
+            blank = pc.equal(pc.utf8_trim_whitespace(column), '')
+            columns[j] = pc.if_else(long, dates.cast(pa.date32()).cast(pa.string()), pc.if_else(blank, null, column))
+        for j in number_fields:
+            column = pc.utf8_trim_whitespace(columns[j])
+            columns[j] = pc.if_else(pc.equal(column, ''), null, column)
+        for j in id_fields:
+            column = columns[j]
+            valid = pc.and_(pc.match_substring_regex(column, BIGINT_PATTERN),
+                            pc.or_(pc.less(pc.utf8_length(column), 19), pc.less_equal(column, str(BIGINT_MAX))))
+            wrong = pc.and_(pc.invert(valid), pc.greater(pc.utf8_length(column), 0)) # empty values are NULL, which is fine
+            n_wrong = pc.sum(wrong.cast(pa.int64())).as_py() or 0
+            if n_wrong:
+                found = invalid.setdefault(j, [0, []])
+                found[0] += n_wrong
+                found[1] += pc.filter(column, wrong).to_pylist()[:10 - len(found[1])]
+                columns[j] = pc.if_else(pc.fill_null(wrong, False), null, column)
+        return pa.RecordBatch.from_arrays(columns, names=header)
+    return convert
+
+def arrow_batches(txt_path, header, start, end, fields=(), stats=None, block_size=ARROW_BLOCK_SIZE):
+    # yields the converted record batches of the rows of a txt file starting within [start, end), of block_size bytes of text
+    # (a compressed source is read from its stream rather than memory-mapped); as converted_batches, a ValueError reports
+    # the identifiers that could not be stored as BIGINT once all the rows are read, and stats gets the time per stage
+    # (the csv reader both reads and parses, its time counts as parsing)
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.csv as pa_csv
+    convert = arrow_converter(header, fields)
+    invalid = {}
+    read_options = pa_csv.ReadOptions(column_names=header, block_size=block_size, use_threads=False, encoding='latin1')
+    if is_compressed(txt_path):
+        source = open_txt(txt_path)
+        read_options.skip_rows = 1 if start > 0 else 0 # the header
+    else:
+        start, end = line_range(txt_path, start, end)
+        source = pa.BufferReader(pa.memory_map(txt_path).read_at(end - start, start)) # a slice of the mapped file, not a copy
+    reader = pa_csv.open_csv(source, read_options=read_options,
+                             parse_options=pa_csv.ParseOptions(delimiter='\t', quote_char='"'),
+                             convert_options=pa_csv.ConvertOptions(column_types={column: pa.string() for column in header},
+                                                                   strings_can_be_null=True, null_values=['']))
+    clock = time.perf_counter
+    if stats:
+        stats.start()
+    with source:
+        while True:
+            started = clock()
+            try:
+                batch = reader.read_next_batch()
+            except StopIteration:
+                break
+            parsed = clock()
+            batch = convert(batch, invalid)
+            converted = clock()
+            yield batch
+            if stats:
+                # the bytes of the values and their separators, as an estimate of the bytes of text read
+                n_bytes = sum(pc.sum(pc.binary_length(column)).as_py() or 0 for column in batch.columns) + batch.num_rows * len(header)
+                stats.batch_done(batch.num_rows, n_bytes, 0, parsed - started, converted - parsed, clock() - converted)
+    if stats:
+        stats.done()
+    if invalid:
+        raise ValueError(os.path.basename(txt_path.split('::')[-1]) + ': values that cannot be stored as BIGINT - '
+                         + '; '.join(header[j] + ': ' + str(n) + ' (e.g. ' + ', '.join(repr(v) for v in values) + ')' for j, (n, values) in sorted(invalid.items())))
+
+def typed_batch(batch, schema):
+    # casts a record batch of strings from arrow_batches to the types of schema (arrow_schema), as record_batch does for rows
+    import pyarrow as pa
+    return pa.RecordBatch.from_arrays([column.cast(arrow_field.type) for column, arrow_field in zip(batch.columns, schema)], schema=schema)
+
+def csv_bytes(batch):
+    # a record batch of strings as csv rows, as written by the csv module (empty cells unquoted, CRLF line ends),
+    # except that when a value of the batch needs quotes, all the values of the batch are quoted
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+    out = pa.BufferOutputStream()
+    try:
+        pa_csv.write_csv(batch, out, pa_csv.WriteOptions(include_header=False, eol='\r\n', quoting_style='none'))
+    except pa.ArrowInvalid: # a value with a comma, a quote or a line break
+        out = pa.BufferOutputStream()
+        pa_csv.write_csv(batch, out, pa_csv.WriteOptions(include_header=False, eol='\r\n', quoting_style='needed'))
+    return out.getvalue()
+
+
+## Lookups and dictionaries (needs the pyarrow library, only imported when used)
+# the analysis-ready tables of Step1F carry, next to each field that maps to a lookup table, a dictionary or a reference table,
+# the descriptions, terms and codes found there, so that queries do not have to join them; the tables a field maps to are
+# found from the 'Mapping' of its metadata ('Lookup: Gender.txt', 'Lookup: Medical dictionary', 'Link Practice table')
+# the columns of the medical and product dictionaries carried next to a medcodeid/prodcodeid
+DICTIONARY_COLUMNS = {'MedicalDictionary': ['term', 'cleansedreadcode', 'snomedctconceptid', 'snomedctdescriptionid', 'emiscodecategoryid'],
+                      'ProductDictionary': ['termfromemis', 'productname', 'formulation', 'routeofadministration', 'drugsubstancename',
+                                            'substancestrength', 'bnfchapter', 'dmdid']}
+REFERENCE_TABLES = ('Practice', 'Staff') # small tables linked to by pracid/staffid, whose own lookup fields are carried
+
+def mapped_table(field):
+    # name of the table a metadata field is looked up in: a lookup txt file ('Lookup: Gender.txt' -> 'Gender',
+    # 'Lookup: common_ dosages.txt' -> 'common_dosages'), the medical or product dictionary, or a reference table
+    # ('Link Practice table' -> 'Practice'); None for the other fields
+    mapping = field.get('Mapping') or ''
+    lookup = re.match(r'Lookups?:? *([\w ]+?)\.txt', mapping)
+    if lookup:
+        return lookup.group(1).replace(' ', '')
+    if re.match(r'(Lookup: )?Medical dictionary', mapping):
+        return 'MedicalDictionary'
+    if re.match(r'(Lookup: )?Product dictionary', mapping):
+        return 'ProductDictionary'
+    link = re.match(r'Link (\w+) table$', mapping)
+    if link and link.group(1) in REFERENCE_TABLES:
+        return link.group(1)
+    return None
+
+def is_lookup_field(field):
+    # field mapping to a lookup txt file, rather than to a dictionary or a reference table
+    return mapped_table(field) not in (None, 'MedicalDictionary', 'ProductDictionary') + REFERENCE_TABLES
+
+def read_lookup_table(data_path, data_format, table, fields, manifest):
+    # pyarrow Table of all the rows of a table of the Step1B output (its csv files, typed from the metadata fields as the
+    # parquet files are, or its parquet dataset), with lower case column names, and the paths of the files read;
+    # None when the table is not in the output
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+    import pyarrow.dataset as ds
+    if data_format == 'parquet':
+        tables = {name.lower(): name for name in os.listdir(data_path) if os.path.isdir(data_path + '/' + name)}
+        if table.lower() not in tables:
+            return None, []
+        dataset = ds.dataset(data_path + '/' + tables[table.lower()], format='parquet', partitioning='hive')
+        data = dataset.to_table()
+        paths = dataset.files
+    else:
+        paths = [csv_path for name, csv_path in data_csv_files(data_path, manifest) if table_name(name).lower() == table.lower()]
+        if not paths:
+            return None, []
+        parts = []
+        for csv_path in paths:
+            with open_csv(csv_path) as csv_file:
+                header = next(csv.reader(csv_file), [])
+            with open_csv(csv_path) as csv_file:
+                parts.append(pa_csv.read_csv(csv_file.buffer, convert_options=pa_csv.ConvertOptions(
+                    column_types=arrow_schema(header, fields), strings_can_be_null=True, null_values=[''])))
+        data = pa.concat_tables(parts)
+    return data.rename_columns([name.lower() for name in data.column_names]), sorted(paths)
+
+class LookupCache:
+    # the lookup tables, dictionaries and reference tables of the Step1B output, each read once (on first use) and kept in
+    # memory as its key column (the first field of its metadata, e.g. pracid, which a partitioned dataset reads last) and the
+    # columns carried next to the fields that map to it, the string ones dictionary-encoded: a description or term is stored
+    # once, however many rows carry it (pandas reads these columns as categoricals)
+    # a reference table carries its own lookup fields, resolved (e.g. Practice: region and region_description), and a
+    # dictionary its DICTIONARY_COLUMNS (the medical dictionary also the description of its emiscodecategoryid)
+    def __init__(self, data_path, data_format, metadata_path, metadata_version, typed_ids=False):
+        self.data_path = data_path
+        self.data_format = data_format
+        self.metadata_path = metadata_path
+        self.metadata_version = metadata_version
+        self.typed_ids = typed_ids
+        self.manifest = Manifest(data_path + '/manifest.json')
+        self.tables = {} # {table name (lower case): (key column name, keys, [(column name, values)]) or None}
+        self.key_sets = {} # {(table name, type): keys cast to that type}
+        self.files = {} # {path: sha256} of the files read
+
+    def fields(self, table):
+        # metadata fields of a table, [] without metadata
+        try:
+            fields = read_metadata(self.metadata_path, table, self.metadata_version)
+        except FileNotFoundError:
+            return []
+        return typed_id_fields(fields) if self.typed_ids else fields
+
+    def entry(self, table):
+        if table.lower() not in self.tables:
+            self.tables[table.lower()] = self.load(table)
+        return self.tables[table.lower()]
+
+    def load(self, table):
+        import pyarrow as pa
+        import pyarrow.compute as pc
+        fields = self.fields(table)
+        data, paths = read_lookup_table(self.data_path, self.data_format, table, fields, self.manifest)
+        if data is None:
+            return None
+        for path in paths:
+            self.files[path] = file_sha256(path)
+        key_name = data.column_names[0]
+        if fields and fields[0]['Field name'].lower() in data.column_names:
+            key_name = fields[0]['Field name'].lower()
+        names = [key_name] + [name for name in data.column_names if name != key_name]
+        if table in DICTIONARY_COLUMNS:
+            columns = [name for name in DICTIONARY_COLUMNS[table] if name in names]
+        elif table in REFERENCE_TABLES:
+            columns = [name for name in names[1:] if is_lookup_field(find_field(fields, name) or {})]
+        else: # a lookup table: its description (Common_Dosages: its dosage text)
+            columns = ['description'] if 'description' in names else names[1:2]
+        carried = []
+        for name in columns:
+            column = data.column(name).combine_chunks()
+            carried.append((name, pc.dictionary_encode(column) if pa.types.is_string(column.type) else column))
+            field = find_field(fields, name)
+            if field and is_lookup_field(field):
+                carried += self.carried_columns(name, mapped_table(field), column)
+        return key_name, data.column(key_name).combine_chunks(), carried
+
+    def carried_columns(self, field_name, table, column):
+        # [(column name, values)] carried next to a column (pyarrow array) of field field_name, which maps to table:
+        # each carried column of the table, taken at the row of the table whose key is the value of the field (null if none)
+        # they are named after the table's columns, prefixed with the field name without its 'id' when it is not the key of
+        # the table (e.g. usualgpstaffid: usualgpstaff_jobcatid); a lookup description after the field (gender_description)
+        import pyarrow as pa
+        import pyarrow.compute as pc
+        entry = self.entry(table)
+        if entry is None:
+            return []
+        key_name, keys, carried = entry
+        key_set = (table.lower(), str(column.type))
+        if key_set not in self.key_sets:
+            try:
+                self.key_sets[key_set] = keys.cast(column.type)
+            except (pa.ArrowInvalid, pa.ArrowNotImplementedError): # e.g. a key that is not a number: compare as strings
+                self.key_sets[key_set] = None
+        value_set = self.key_sets[key_set]
+        if value_set is None:
+            column, value_set = column.cast(pa.string()), keys.cast(pa.string())
+        positions = pc.index_in(column, value_set=value_set)
+        base = re.sub('id$', '', field_name.lower())
+        prefix = '' if field_name.lower() == key_name else base + '_'
+        return [(base + '_description' if name == 'description' else prefix + name, values.take(positions)) for name, values in carried]
+
+def analysis_batch(batch, fields, cache):
+    # a record batch of an event table with the columns carried by the fields that map to a table of the cache (which is
+    # loaded on first use), each inserted after its field; a table that is not in the Step1B output carries nothing
+    import pyarrow as pa
+    names = batch.schema.names
+    columns = []
+    out_names = []
+    for name, column in zip(names, batch.columns):
+        columns.append(column)
+        out_names.append(name)
+        field = find_field(fields, name)
+        table = mapped_table(field) if field else None
+        if table:
+            for carried_name, values in cache.carried_columns(name, table, column):
+                if carried_name not in names and carried_name not in out_names:
+                    columns.append(values)
+                    out_names.append(carried_name)
+    return pa.RecordBatch.from_arrays(columns, names=out_names)
+
+
+## DuckDB (needs the duckdb library, only imported when used)
+def duckdb_type(field):
+    # DuckDB data type of a metadata field, as arrow_type: NUMERIC/DECIMAL p.s as DECIMAL(p,s), without precision as DOUBLE
+    if field is None or field['Type'] == 'TEXT':
+        return 'VARCHAR'
+    if field['Type'] in ('DATE', 'INTEGER', 'BIGINT'):
+        return field['Type']
+    if field['Type'] in ('NUMERIC', 'DECIMAL'):
+        precision_scale = re.match(r'\s*(\d+)\.(\d+)', field.get('Format', ''))
+        if precision_scale:
+            return 'DECIMAL(' + precision_scale.group(1) + ',' + precision_scale.group(2) + ')'
+        return 'DOUBLE'
+    return 'VARCHAR'
+
+def duckdb_csv_sql(csv_paths, fields):
+    # DuckDB read_csv() of the Step1B csv files of a table (all with the same header), typed from the metadata fields
+    # (DuckDB decompresses .csv.gz and .csv.zst files itself, from their extension)
+    with open_csv(csv_paths[0]) as csv_file:
+        header = next(csv.reader(csv_file), [])
+    columns = ', '.join("'" + column + "': '" + duckdb_type(find_field(fields, column)) + "'" for column in header)
+    files = ', '.join("'" + path.replace("'", "''") + "'" for path in csv_paths)
+    return ('read_csv([' + files + '], header = true, delim = \',\', quote = \'"\', dateformat = \'%Y-%m-%d\', '
+            'auto_detect = false, columns = {' + columns + '})')
+
+def duckdb_parquet_sql(dataset_path):
+    # DuckDB read_parquet() of a Step1B parquet dataset directory, including its pracid/year hive partitions
+    return "read_parquet('" + dataset_path.replace("'", "''") + "/**/*.parquet', hive_partitioning = true)"
@@ -0,0 +1,239 @@
+# Cohort extraction from code lists: the patients with (first, last or all) events matching each of many code lists,
+# in a single pass over Observation (medical code lists) and DrugIssue (product code lists), rather than one query per list
+# Run as: python cohort_extract.py path-to-files code-list.csv [code-list.csv ...] [--source csv|parquet|postgres|duckdb] [--events first|last|all]
+# E.g. python cohort_extract.py /proc-data/SYN_AURUM codelists/*.csv --source postgres --dsn "dbname=cprd" --events first
+# Or from a notebook (in this directory):
+#   import cohort_extract
+#   cohorts = cohort_extract.extract(cohort_extract.CsvSource('/proc-data/SYN_AURUM'), cohort_extract.read_code_lists(['type2diabetes.csv']))
+# Each code list is a csv file with a header, as downloaded from code list repositories; its codes are taken from a column
+# named like a medcodeid (e.g. MEDICAL_CODE_ID), a prodcodeid (e.g. DRUG_CODE_ID) or a SNOMED CT concept id (e.g. SNOMED_CT_CODE)
+# SNOMED CT codes are resolved to medcodeids through the medical dictionary; all the codes then go into one in-memory hash index
+# (code -> code lists), which every event row is looked up in once, whatever the number of code lists
+# The events are read from the Step1B csv or parquet files, or from the PostgreSQL (Step1C/Step1D) or DuckDB (Step1E) database;
+# databases are sent all the codes of a table at once, so they also scan each event table once
+# The output is one csv file per code list (patid, event date, code), in path-to-files/cohorts (or --output)
+
+## Libraries
+import os
+import sys
+import argparse
+import csv
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Step1-PreProc'))
+import aurum_utils
+
+# the event table, its event date and the dictionary of each kind of code
+EVENT_TABLES = {'medcodeid': ('Observation', 'obsdate', 'MedicalDictionary'), 'prodcodeid': ('DrugIssue', 'issuedate', 'ProductDictionary')}
+# column names (lower case) recognised in the code list files, by kind of code, in order of preference
+CODE_COLUMNS = {'medcodeid': ['medcodeid', 'medical_code_id', 'medcode'], 'prodcodeid': ['prodcodeid', 'drug_code_id', 'prodcode'],
+                'snomedctconceptid': ['snomedctconceptid', 'snomed_ct_code', 'snomed_code', 'conceptid']}
+
+## Code lists
+def read_code_list(path):
+    # returns the kind of codes ('medcodeid', 'prodcodeid' or 'snomedctconceptid') and the set of codes of a code list file
+    with open(path, newline='', encoding='utf-8-sig') as f:
+        reader = csv.reader(f)
+        header = [name.strip().lower() for name in next(reader, [])]
+        rows = list(reader)
+    for kind, names in CODE_COLUMNS.items():
+        for name in names:
+            if name in header:
+                j = header.index(name)
+                return kind, {row[j].strip() for row in rows if j < len(row) and row[j].strip()}
+    raise ValueError(path + ': no medcodeid, prodcodeid or SNOMED CT code column found in ' + str(header))
+
+def read_code_lists(paths):
+    # {code list name (file name without extension): (kind, codes)}
+    return {os.path.splitext(os.path.basename(path))[0]: read_code_list(path) for path in paths}
+
+## Sources of rows
+# each source has a rows(table, fields, where_field, values) method, which yields the given fields (as strings, dates as
+# YYYY-MM-DD, empty as '') of the rows of a table whose where_field is in the set values
+class CsvSource:
+    # the Step1B csv files, in path-to-files/data_csv (the part and partition files of a table are read one after the other,
+    # compressed ones decompressed as they are read)
+    def __init__(self, path):
+        self.data_path = path + '/data_csv'
+        manifest = aurum_utils.Manifest(self.data_path + '/manifest.json')
+        self.files = {}
+        for name, csv_path in aurum_utils.data_csv_files(self.data_path, manifest):
+            self.files.setdefault(aurum_utils.table_name(name).lower(), []).append(csv_path)
+
+    def rows(self, table, fields, where_field, values):
+        if table.lower() not in self.files:
+            raise FileNotFoundError('no csv files of ' + table + ' in ' + self.data_path)
+        for csv_path in self.files[table.lower()]:
+            with aurum_utils.open_csv(csv_path) as csv_file:
+                reader = csv.reader(csv_file)
+                header = [name.lower() for name in next(reader, [])]
+                columns = [header.index(field.lower()) for field in fields]
+                w = header.index(where_field.lower())
+                for row in reader:
+                    if row[w] in values:
+                        yield tuple(row[j] for j in columns)
+
+class ParquetSource:
+    # the Step1B parquet datasets, in path-to-files/data_parquet (needs the pyarrow library)
+    # only the needed columns are read, and the rows are filtered on where_field by pyarrow, batch by batch
+    def __init__(self, path):
+        self.data_path = path + '/data_parquet'
+
+    def rows(self, table, fields, where_field, values):
+        import pyarrow as pa
+        import pyarrow.dataset as ds
+        tables = {name.lower(): name for name in os.listdir(self.data_path)}
+        if table.lower() not in tables:
+            raise FileNotFoundError('no parquet dataset of ' + table + ' in ' + self.data_path)
+        dataset = ds.dataset(self.data_path + '/' + tables[table.lower()], format='parquet', partitioning='hive')
+        names = {name.lower(): name for name in dataset.schema.names}
+        where_type = dataset.schema.field(names[where_field.lower()]).type # int64 for identifiers typed by Step1B --typed-ids
+        if where_type == pa.int64(): # a code that is not a number cannot match
+            values = {value for value in values if aurum_utils.is_bigint(value)}
+        where = ds.field(names[where_field.lower()]).isin(pa.array(sorted(values), pa.string()).cast(where_type))
+        for batch in dataset.to_batches(columns=[names[field.lower()] for field in fields], filter=where):
+            columns = [[('' if value is None else str(value)) for value in column.to_pylist()] for column in batch.columns]
+            yield from zip(*columns)
+
+class DatabaseSource:
+    # a PostgreSQL (psycopg2) or DuckDB connection; the values are sent as one array parameter, cast to the type of the
+    # column (TEXT, or BIGINT with --typed-ids), so each call is a single query (and a single scan of the table)
+    def __init__(self, connection, kind):
+        self.connection = connection
+        self.kind = kind
+        self.parameter = '%s' if kind == 'postgres' else '?'
+
+    def column_type(self, table, field):
+        cursor = self.connection.cursor()
+        cursor.execute('SELECT data_type FROM information_schema.columns WHERE lower(table_name) = lower(' + self.parameter
+                       + ') AND lower(column_name) = lower(' + self.parameter + ')', (table, field))
+        row = cursor.fetchone()
+        cursor.close()
+        if row is None:
+            raise KeyError('no column ' + field + ' in ' + table)
+        return row[0]
+
+    def rows(self, table, fields, where_field, values):
+        select = 'SELECT ' + ', '.join(fields) + ' FROM ' + table
+        values_type = self.column_type(table, where_field) + '[]'
+        if values_type.lower() == 'bigint[]': # a code that is not a number cannot match
+            values = {value for value in values if aurum_utils.is_bigint(value)}
+        if self.kind == 'postgres':
+            cursor = self.connection.cursor(name='cohort_extract') # server-side cursor, so the rows are streamed
+            cursor.itersize = 100000
+            cursor.execute(select + ' WHERE ' + where_field + ' = ANY(%s::' + values_type + ')', (sorted(values),))
+        else:
+            cursor = self.connection.cursor()
+            cursor.execute(select + ' WHERE ' + where_field + ' IN (SELECT UNNEST(?::' + values_type + '))', [sorted(values)])
+        try:
+            while True:
+                batch = cursor.fetchmany(100000)
+                if not batch:
+                    break
+                for row in batch:
+                    yield tuple('' if value is None else str(value) for value in row)
+        finally:
+            cursor.close()
+
+## Extraction
+def build_index(source, code_lists):
+    # the hash index of the codes of each kind: {'medcodeid': {code: [code list numbers]}, 'prodcodeid': {...}}
+    # SNOMED CT concept ids are resolved to medcodeids with the medical dictionary
+    # also prints, for each code list, how many of its codes were found in the dictionaries
+    index = {'medcodeid': {}, 'prodcodeid': {}}
+    snomed = {}
+    for k, (name, (kind, codes)) in enumerate(code_lists.items()):
+        if kind == 'snomedctconceptid':
+            for code in codes:
+                snomed.setdefault(code, []).append(k)
+        else:
+            for code in codes:
+                index[kind].setdefault(code, []).append(k)
+    if snomed:
+        for medcodeid, concept in source.rows('MedicalDictionary', ['medcodeid', 'snomedctconceptid'], 'snomedctconceptid', set(snomed)):
+            for k in snomed[concept]:
+                if k not in index['medcodeid'].setdefault(medcodeid, []):
+                    index['medcodeid'][medcodeid].append(k)
+    for kind, codes in index.items():
+        dictionary = EVENT_TABLES[kind][2]
+        found = [0] * len(code_lists)
+        try:
+            for (code,) in source.rows(dictionary, [kind], kind, set(codes)):
+                for k in codes[code]:
+                    found[k] += 1
+        except (FileNotFoundError, KeyError, ValueError) as error:
+            if codes:
+                print('could not check the codes against', dictionary, '-', error)
+            continue
+        for k, (name, (list_kind, list_codes)) in enumerate(code_lists.items()):
+            if list_kind == kind:
+                print('code list:', name, '|', kind, 'codes:', len(list_codes), '| in', dictionary + ':', found[k])
+            elif list_kind == 'snomedctconceptid' and kind == 'medcodeid':
+                print('code list:', name, '| SNOMED CT codes:', len(list_codes), '| medcodeids in', dictionary + ':', found[k])
+    return index
+
+def extract(source, code_lists, events='first'):
+    # the events of each code list: {code list name: [(patid, event date, code)]} sorted by patid then date, with
+    # events='first' or 'last' one row per patient (their first/last dated event), with events='all' every matching event
+    # each event table with codes to look for is read once, for all the code lists
+    index = build_index(source, code_lists)
+    names = list(code_lists)
+    found = [{} if events != 'all' else [] for _ in names]
+    for kind, codes in index.items():
+        if not codes:
+            continue
+        table, date_field, _ = EVENT_TABLES[kind]
+        started = time.perf_counter()
+        n_rows = 0
+        for patid, date, code in source.rows(table, ['patid', date_field, kind], kind, set(codes)):
+            n_rows += 1
+            for k in codes[code]:
+                if events == 'all':
+                    found[k].append((patid, date, code))
+                elif date:
+                    current = found[k].get(patid)
+                    if current is None or (date < current[0] if events == 'first' else date > current[0]):
+                        found[k][patid] = (date, code)
+        print('scanned:', table, '| matching events:', n_rows, '| seconds:', round(time.perf_counter() - started, 2))
+    cohorts = {}
+    for k, name in enumerate(names):
+        rows = found[k] if events == 'all' else [(patid, date, code) for patid, (date, code) in found[k].items()]
+        cohorts[name] = sorted(rows)
+    return cohorts
+
+def write_cohorts(cohorts, code_lists, path_to):
+    # one csv file per code list, with the patid, event date and code of its events
+    os.makedirs(path_to, exist_ok=True)
+    for name, rows in cohorts.items():
+        kind = code_lists[name][0]
+        kind = 'medcodeid' if kind == 'snomedctconceptid' else kind
+        with open(path_to + '/' + name + '.csv', 'w', newline='') as csv_file:
+            writer = csv.writer(csv_file)
+            writer.writerow(['patid', EVENT_TABLES[kind][1], kind])
+            writer.writerows(rows)
+        print('cohort:', name, '| events:', len(rows), '| patients:', len({row[0] for row in rows}))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Extract the patients and events matching many code lists in a single pass')
+    parser.add_argument('path', help='directory of the processed extract (containing data_csv or data_parquet)')
+    parser.add_argument('code_lists', nargs='+', help='code list csv files')
+    parser.add_argument('--source', choices=['csv', 'parquet', 'postgres', 'duckdb'], default='csv', help='where to read the events from (default: csv)')
+    parser.add_argument('--dsn', default='', help='postgres: libpq connection string (default: libpq defaults/PG* environment variables)')
+    parser.add_argument('--database', help='duckdb: the Step1E database file (default: path/cprd.duckdb)')
+    parser.add_argument('--events', choices=['first', 'last', 'all'], default='first', help='first or last event of each patient, or all events (default: first)')
+    parser.add_argument('--output', help='directory to write the cohort csv files to (default: path/cohorts)')
+    args = parser.parse_args()
+
+    code_lists = read_code_lists(args.code_lists)
+    if args.source == 'csv':
+        source = CsvSource(args.path)
+    elif args.source == 'parquet':
+        source = ParquetSource(args.path)
+    elif args.source == 'postgres':
+        import psycopg2
+        source = DatabaseSource(psycopg2.connect(args.dsn), 'postgres')
+    else:
+        import duckdb
+        source = DatabaseSource(duckdb.connect(args.database or args.path + '/cprd.duckdb', read_only=True), 'duckdb')
+    write_cohorts(extract(source, code_lists, args.events), code_lists, args.output or args.path + '/cohorts')
@@ -0,0 +1,114 @@
+# Micro-benchmark of the date rewriting done by Step1B
+# Run as: python bench_date_conversion.py [--rows 10000000] [--batch-size 100000]
+# Writes a synthetic Observation-shaped txt file (two date columns per row, some empty) to a temporary directory,
+# then streams it in batches as Step1B does and times, on the same batches:
+#  - 'per-cell': the original loop calling strptime/strftime on every date cell and checking 'j in date_fields' for every cell
+#  - 'lookup': convert_dates, which only visits the date columns and memoizes each distinct date string (aurum_utils.DateLookup)
+#  - 'converter': aurum_utils.row_converter, compiled from the Observation metadata types (DATE and NUMERIC columns), as Step1B uses
+# The results are compared to check that the output is unchanged
+
+## Libraries
+import os
+import sys
+import argparse
+import csv
+import datetime
+import random
+import tempfile
+import time
+from itertools import islice
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Step1-PreProc'))
+import aurum_utils
+
+## Functions
+def write_synthetic_observation(path, n_rows, seed=1):
+    # Observation layout with random obsdate/enterdate between 1950 and 2021, ~10% of obsdate left empty
+    random.seed(seed)
+    header = ['patid','consid','pracid','obsid','obsdate','enterdate','staffid','parentobsid','medcodeid','value','numunitid','obstypeid','numrangelow','numrangehigh','probobsid']
+    first_day = datetime.date(1950, 1, 1).toordinal()
+    n_days = datetime.date(2021, 10, 1).toordinal() - first_day
+    with open(path, 'w', encoding='latin1') as txt_file:
+        txt_file.write('\t'.join(header) + '\n')
+        for i in range(n_rows):
+            pracid = str(20001 + i % 400)
+            obsdate = datetime.date.fromordinal(first_day + random.randrange(n_days)).strftime('%d/%m/%Y')
+            enterdate = datetime.date.fromordinal(first_day + random.randrange(n_days)).strftime('%d/%m/%Y')
+            txt_file.write('\t'.join([str(i // 20) + pracid, str(i // 3), pracid, str(10**12 + i), obsdate if i % 10 else '', enterdate,
+                                      str(i % 1000), '', str(random.randrange(10**6, 10**7)), '', '', '10', '', '', '']) + '\n')
+    return header
+
+def observation_fields():
+    # the metadata types of the Observation columns that row_converter converts (the others are TEXT or INTEGER)
+    return ([{'Field name': name, 'Type': 'DATE'} for name in ['obsdate', 'enterdate']]
+            + [{'Field name': name, 'Type': 'NUMERIC'} for name in ['value', 'numrangelow', 'numrangehigh']])
+
+def per_cell_strptime(data, date_fields):
+    # the original Step1B inner loop
+    for i, row in enumerate(data):
+        for j, col in enumerate(row):
+            if (len(col)>6) & (j in date_fields):
+                data[i][j] = datetime.datetime.strptime(col, "%d/%m/%Y").strftime("%Y-%m-%d")
+    return data
+
+def convert_dates(data, date_fields, lookup):
+    # the first rewrite of the Step1B loop: only the date columns are visited, each distinct date string is parsed once
+    if not date_fields:
+        return data
+    get = lookup.__getitem__
+    n_fields = max(date_fields) + 1
+    for row in data:
+        if len(row) >= n_fields:
+            for j in date_fields:
+                row[j] = get(row[j])
+        else: # short row, only convert the date columns that it has
+            for j in date_fields:
+                if j < len(row):
+                    row[j] = get(row[j])
+    return data
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark per-cell strptime against the memoized date lookup and the compiled row converter')
+    parser.add_argument('--rows', type=int, default=10000000, help='number of rows in the synthetic file (default: 10000000)')
+    parser.add_argument('--batch-size', type=int, default=100000, help='rows per batch, as in Step1B (default: 100000)')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        txt_path = os.path.join(tmp_dir, 'Observation.txt')
+        print('writing', args.rows, 'synthetic rows to', txt_path)
+        header = write_synthetic_observation(txt_path, args.rows)
+        date_fields = [idx for idx, x in enumerate(header) if ('date' in x) or (x == 'lcd')]
+
+        timings = {'per-cell': 0.0, 'lookup': 0.0, 'converter': 0.0}
+        date_lookup = aurum_utils.DateLookup()
+        convert = aurum_utils.row_converter(header, observation_fields())
+        with open(txt_path, 'r', encoding='latin1') as txt_file:
+            r = csv.reader(txt_file, delimiter='\t', quotechar='"')
+            next(r)
+            while True:
+                batch = list(islice(r, args.batch_size))
+                if not batch:
+                    break
+                copy = [list(row) for row in batch]
+                converted = [list(row) for row in batch]
+
+                start = time.perf_counter()
+                per_cell_strptime(batch, date_fields)
+                timings['per-cell'] += time.perf_counter() - start
+
+                start = time.perf_counter()
+                convert_dates(copy, date_fields, date_lookup)
+                timings['lookup'] += time.perf_counter() - start
+
+                start = time.perf_counter()
+                convert(converted)
+                timings['converter'] += time.perf_counter() - start
+
+                if batch != copy or batch != converted:
+                    sys.exit('Output of the engines differs!')
+
+    for engine, seconds in timings.items():
+        print(engine, '| seconds:', round(seconds, 2), '| rows/sec:', round(args.rows / seconds) if seconds > 0 else args.rows)
+    print('distinct dates parsed:', len(date_lookup))
+    print('speedup:', round(timings['per-cell'] / timings['lookup'], 1), 'x (lookup),', round(timings['per-cell'] / timings['converter'], 1), 'x (converter)')
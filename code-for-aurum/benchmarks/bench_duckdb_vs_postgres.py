@@ -0,0 +1,133 @@
+# Benchmark of the Step2 notebook queries on DuckDB (Step1E) against PostgreSQL (Step1C or Step1D)
+# Run as: python bench_duckdb_vs_postgres.py path-to-files [--database path] [--dsn "dbname=cprd"] [--repeat 3] [--json path]
+# The same extract has to be loaded on both sides: the DuckDB database created by Step1E-Create-duckdb.py (by default
+# path-to-files/cprd.duckdb) and the PostgreSQL database loaded by Step1C/Step1D (--dsn, libpq defaults if not given)
+# Each query from the Step2B (statistics) and Step2C (cohort) notebooks is run --repeat times on each side; the best time
+# is reported, and the results of the two sides are compared (numbers rounded to 4 decimals, rows in any order)
+# Queries on tables missing from either side are skipped; with --no-postgres (or --no-duckdb) only one side is timed
+# With --json, the best times are also written to a json file, as {backend: {query: seconds}} (used by bench_pipeline.py)
+
+## Libraries
+import argparse
+import datetime
+import decimal
+import json
+import time
+
+## Queries from the notebooks, written so that the same SQL runs on both
+# (the Step2C cohort queries are written with CTEs instead of the SELECT ... INTO helper tables of the notebook)
+FOLLOWUP_YEARS = """(CASE WHEN regenddate IS NULL THEN '2021-10-01' ELSE regenddate END
+    - CASE WHEN regstartdate < '1995-01-01' THEN '1995-01-01' ELSE regstartdate END)/365.0"""
+
+NOTEBOOK_QUERIES = [
+    ('2B acceptable patients', "SELECT COUNT(*) FROM patient WHERE acceptable = 1"),
+    ('2B current patients', "SELECT COUNT(*) FROM patient WHERE acceptable = 1 AND cprd_ddate IS NULL AND regenddate IS NULL"),
+    ('2B follow-up average', "SELECT AVG(" + FOLLOWUP_YEARS + ") FROM patient"),
+    ('2B follow-up quartiles', "WITH cte AS (SELECT " + FOLLOWUP_YEARS + """ AS followup_years FROM patient)
+    SELECT percentile_disc(0.25) WITHIN GROUP (ORDER BY followup_years) FROM cte
+    UNION ALL SELECT percentile_disc(0.5) WITHIN GROUP (ORDER BY followup_years) FROM cte
+    UNION ALL SELECT percentile_disc(0.75) WITHIN GROUP (ORDER BY followup_years) FROM cte"""),
+    ('2B follow-up stddev', "SELECT STDDEV(" + FOLLOWUP_YEARS + ") FROM patient"),
+    ('2B current follow-up stddev', "SELECT STDDEV(" + FOLLOWUP_YEARS + ") FROM patient WHERE regenddate IS NULL AND cprd_ddate IS NULL"),
+    ('2B practices per region', """SELECT re.description AS region, COUNT(pr.pracid) AS totalpractices
+    FROM practice pr INNER JOIN region re ON re.regionid = pr.region GROUP BY pr.region, re.description"""),
+    # the same statistics from the PatientSummary table created by Step1C/Step1D/Step1E
+    ('2B follow-up average (summary)', "SELECT AVG(followup_days/365.0) FROM patientsummary"),
+    ('2B follow-up quartiles (summary)', """WITH cte AS (SELECT followup_days/365.0 AS followup_years FROM patientsummary)
+    SELECT percentile_disc(0.25) WITHIN GROUP (ORDER BY followup_years) FROM cte
+    UNION ALL SELECT percentile_disc(0.5) WITHIN GROUP (ORDER BY followup_years) FROM cte
+    UNION ALL SELECT percentile_disc(0.75) WITHIN GROUP (ORDER BY followup_years) FROM cte"""),
+    ('2B current follow-up stddev (summary)', "SELECT STDDEV(followup_days/365.0) FROM patientsummary WHERE regenddate IS NULL AND cprd_ddate IS NULL"),
+    ('2C first metformin per year', """WITH metformin AS (
+        SELECT prodcodeid FROM productdictionary WHERE UPPER(drugsubstancename) LIKE '%METFORMIN%'
+    ), metformin_patients AS (
+        SELECT patid, issuedate FROM drugissue di INNER JOIN metformin mp ON mp.prodcodeid = di.prodcodeid GROUP BY patid, issuedate
+    ), added_row_number AS (
+        SELECT *, ROW_NUMBER() OVER(PARTITION BY patid ORDER BY issuedate ASC) AS row_number FROM metformin_patients
+    )
+    SELECT CAST(DATE_PART('YEAR', issuedate) AS INTEGER) AS year, COUNT(patid) FROM added_row_number
+    WHERE row_number = 1 AND issuedate BETWEEN '2004-01-01' AND '2015-12-31'
+    GROUP BY DATE_PART('YEAR', issuedate)"""),
+    ('2C type 2 diabetes observations', """SELECT COUNT(*), COUNT(DISTINCT patid) FROM observation
+    WHERE medcodeid IN (SELECT medcodeid FROM medicaldictionary WHERE LOWER(term) LIKE '%type 2 diabetes%')"""),
+    ('2C first type 2 diabetes observation', """WITH patid_ranked AS (
+        SELECT *, ROW_NUMBER() OVER(PARTITION BY patid ORDER BY obsdate ASC) AS row_number FROM observation
+        WHERE medcodeid IN (SELECT medcodeid FROM medicaldictionary WHERE LOWER(term) LIKE '%type 2 diabetes%')
+    )
+    SELECT COUNT(*) FROM patid_ranked WHERE row_number = 1 AND obsdate <= '2005-12-31'"""),
+]
+
+## Functions
+def normalised(rows):
+    # rows as comparable tuples: numbers (int, float or Decimal) as floats rounded to 4 decimals, dates as text, any order
+    def value(v):
+        if isinstance(v, (int, float, decimal.Decimal)) and not isinstance(v, bool):
+            return round(float(v), 4)
+        if isinstance(v, datetime.date):
+            return v.isoformat()
+        return v
+    return sorted((tuple(value(v) for v in row) for row in rows), key=repr)
+
+def time_query(run, sql, repeat):
+    # best time of 'repeat' runs of sql, and its result
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        rows = run(sql)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, rows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time the Step2 notebook queries on DuckDB and PostgreSQL')
+    parser.add_argument('path', help='directory of the processed extract (containing the Step1E cprd.duckdb)')
+    parser.add_argument('--database', help='DuckDB database file created by Step1E (default: path/cprd.duckdb)')
+    parser.add_argument('--dsn', default='', help='libpq connection string of the PostgreSQL database loaded by Step1C/Step1D (default: libpq defaults/PG* environment variables)')
+    parser.add_argument('--no-postgres', action='store_true', help='only time DuckDB')
+    parser.add_argument('--no-duckdb', action='store_true', help='only time PostgreSQL')
+    parser.add_argument('--repeat', type=int, default=3, help='number of runs of each query, the best is reported (default: 3)')
+    parser.add_argument('--json', help='json file to write the best times to')
+    args = parser.parse_args()
+
+    backends = []
+    if not args.no_duckdb:
+        import duckdb
+        duckdb_connection = duckdb.connect(args.database or args.path + '/cprd.duckdb', read_only=True)
+        backends.append(('DuckDB', lambda sql: duckdb_connection.execute(sql).fetchall()))
+    if not args.no_postgres:
+        import psycopg2
+        postgres_connection = psycopg2.connect(args.dsn)
+        postgres_connection.autocommit = True
+        postgres_cursor = postgres_connection.cursor()
+        def run_postgres(sql):
+            postgres_cursor.execute(sql)
+            return postgres_cursor.fetchall()
+        backends.append(('PostgreSQL', run_postgres))
+
+    print('query'.ljust(38), ''.join(name.rjust(12) for name, _ in backends), 'speed-up'.rjust(9) if len(backends) > 1 else '', 'same result' if len(backends) > 1 else '')
+    totals = [0.0] * len(backends)
+    best_times = {name: {} for name, _ in backends}
+    for label, sql in NOTEBOOK_QUERIES:
+        timings, results = [], []
+        try:
+            for name, run in backends:
+                elapsed, rows = time_query(run, sql, args.repeat)
+                timings.append(elapsed)
+                results.append(normalised(rows))
+        except Exception as error: # e.g. a table missing from the extract
+            print(label.ljust(38), 'skipped:', str(error).strip().splitlines()[0])
+            if not args.no_postgres:
+                postgres_connection.rollback()
+            continue
+        totals = [total + elapsed for total, elapsed in zip(totals, timings)]
+        for (name, _), elapsed in zip(backends, timings):
+            best_times[name][label] = elapsed
+        line = label.ljust(38) + ' ' + ''.join(str(round(elapsed, 3)).rjust(12) for elapsed in timings)
+        if len(backends) > 1:
+            line += ' ' + (str(round(timings[1] / max(timings[0], 1e-9), 1)) + 'x').rjust(9) + ' ' + ('yes' if results[0] == results[1] else 'NO')
+        print(line)
+    print('All queries'.ljust(38), ''.join(str(round(total, 3)).rjust(12) for total in totals))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(best_times, f, indent=1)
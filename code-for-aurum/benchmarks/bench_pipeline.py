@@ -0,0 +1,131 @@
+# Benchmark harness of the whole workflow on synthetic extracts of increasing size
+# Run as: python bench_pipeline.py work-dir [--patients 10000 100000 1000000] [--workers N] [--dsn "dbname=cprd_bench"] [--duckdb]
+# For each number of patients, an extract is generated with generate_synthetic_aurum.py into work-dir/patients_N
+# (and kept, so later runs only regenerate it if the generator options change), the Step1A metadata is written next to it,
+# then each stage runs as its own process, timed and with its peak memory (RSS) measured:
+# - Step1B: conversion of the txt files to csv, with --workers processes
+# - Step1C: generation of the SQL, then its run by psql into the --dsn database, which has to be on this machine as
+#   COPY reads the csv files (the RSS of the load is that of psql, the server's memory is not included)
+# - Step1E: creation of a materialized DuckDB database, with --duckdb
+# then the Step2 notebook queries are timed on PostgreSQL and/or DuckDB by bench_duckdb_vs_postgres.py
+# (on Linux, a process's peak RSS includes what it inherited from the process that started it, so this script stays small
+# and leaves the database libraries to the processes it runs)
+# The results are printed and appended to a json file (--results), so that runs before and after a change can be compared
+
+## Libraries
+import os
+import sys
+import argparse
+import datetime
+import json
+import shutil
+import subprocess
+import time
+
+benchmarks_path = os.path.dirname(os.path.abspath(__file__))
+step1_path = os.path.join(benchmarks_path, '..', 'Step1-PreProc')
+sys.path.insert(0, step1_path)
+import aurum_utils
+
+## Functions
+def run_stage(command, cwd, log_path):
+    # runs command, with its output going to log_path; returns the seconds it took and its peak RSS in MB
+    # (the largest RSS of the process and any of its worker processes)
+    started = time.perf_counter()
+    with open(log_path, 'w') as log_file:
+        process = subprocess.Popen(command, cwd=cwd, stdout=log_file, stderr=subprocess.STDOUT)
+        _, status, usage = os.wait4(process.pid, 0)
+    elapsed = time.perf_counter() - started
+    if not os.WIFEXITED(status) or os.WEXITSTATUS(status) != 0:
+        with open(log_path) as log_file:
+            print(log_file.read()[-2000:])
+        sys.exit(' '.join(command) + ' failed, see ' + log_path)
+    return elapsed, usage.ru_maxrss / 1024 # ru_maxrss is in KB on Linux
+
+def txt_size(path):
+    return sum(aurum_utils.source_stat(source)[0] for source in aurum_utils.txt_sources(path).values())
+
+def print_stage(name, stage):
+    rows_per_sec = str(round(stage['rows'] / stage['seconds'])) if stage.get('rows') else ''
+    mb_per_sec = str(round(stage['bytes'] / stage['seconds'] / 1e6, 1)) if stage.get('bytes') else ''
+    print('  ' + name.ljust(26), str(round(stage['seconds'], 2)).rjust(9), rows_per_sec.rjust(10), mb_per_sec.rjust(8), str(round(stage['peak_rss_mb'])).rjust(12))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time the workflow stages and Step2 queries on synthetic CPRD Aurum extracts')
+    parser.add_argument('work_dir', help='directory for the generated extracts and their outputs')
+    parser.add_argument('--patients', type=int, nargs='+', default=[10000], help='numbers of patients to run with (default: 10000)')
+    parser.add_argument('--workers', type=int, default=4, help='number of processes for the generator and Step1B (default: 4)')
+    parser.add_argument('--dsn', help='libpq connection string of a PostgreSQL database (on this machine) to load with Step1C; without it, Step1C is not run')
+    parser.add_argument('--duckdb', action='store_true', help='also create a DuckDB database with Step1E and time the queries on it')
+    parser.add_argument('--repeat', type=int, default=3, help='number of runs of each query, the best is reported (default: 3)')
+    parser.add_argument('--results', default='bench_results.json', help='json file the results are appended to (default: bench_results.json)')
+    parser.add_argument('--generator-options', default='', help='extra options for generate_synthetic_aurum.py, e.g. "--observations 200"')
+    args = parser.parse_args()
+
+    python = sys.executable
+    results = []
+    if os.path.isfile(args.results):
+        with open(args.results) as f:
+            results = json.load(f)
+
+    for n_patients in args.patients:
+        path = os.path.abspath(args.work_dir + '/patients_' + str(n_patients))
+        os.makedirs(path + '/metadata_csv', exist_ok=True)
+        run = {'date': datetime.datetime.now().isoformat(timespec='seconds'), 'patients': n_patients, 'workers': args.workers, 'stages': {}, 'queries': {}}
+        print('\n' + str(n_patients), 'patients, in', path)
+
+        # the extract, only regenerated when the generator options change
+        generator_command = [python, benchmarks_path + '/generate_synthetic_aurum.py', path, '--patients', str(n_patients),
+                             '--workers', str(args.workers)] + args.generator_options.split()
+        generated_path = path + '/generated.json'
+        if not os.path.isfile(generated_path) or json.load(open(generated_path)) != generator_command[2:]:
+            # the source files of the old extract: plain or compressed txt files and whole zip archives (a file shadowed by
+            # another of the same name, e.g. a .txt.gz next to its .txt, is only listed once that one is gone)
+            while aurum_utils.txt_sources(path):
+                for source in set(aurum_utils.txt_sources(path).values()):
+                    os.remove(source.split('::')[0])
+            seconds, peak_rss_mb = run_stage(generator_command, path, path + '/generate.log')
+            run['stages']['generate'] = {'seconds': seconds, 'peak_rss_mb': peak_rss_mb}
+            with open(generated_path, 'w') as f:
+                json.dump(generator_command[2:], f)
+        run_stage([python, step1_path + '/Step1A-Generate-metadata-csvs.py'], path, path + '/Step1A.log')
+        n_bytes = txt_size(path)
+
+        # each stage starts from scratch
+        for output in ['data_csv', 'create-tables']:
+            shutil.rmtree(path + '/' + output, ignore_errors=True)
+        if os.path.isfile(path + '/cprd.duckdb'):
+            os.remove(path + '/cprd.duckdb')
+
+        seconds, peak_rss_mb = run_stage([python, step1_path + '/Step1B-Generate-data-csvs.py', path, '--workers', str(args.workers)], path, path + '/Step1B.log')
+        n_rows = sum(entry['rows'] for entry in aurum_utils.Manifest(path + '/data_csv/manifest.json').files.values())
+        run['stages']['Step1B'] = {'seconds': seconds, 'peak_rss_mb': peak_rss_mb, 'rows': n_rows, 'bytes': n_bytes}
+        run['rows'], run['bytes'] = n_rows, n_bytes
+
+        if args.dsn is not None:
+            seconds, peak_rss_mb = run_stage([python, step1_path + '/Step1C-Generate-SQL-queries.py', path, 'v2p9'], path, path + '/Step1C.log')
+            run['stages']['Step1C SQL'] = {'seconds': seconds, 'peak_rss_mb': peak_rss_mb}
+            seconds, peak_rss_mb = run_stage(['psql', '-d', args.dsn, '-q', '-v', 'ON_ERROR_STOP=1', '-f', path + '/create-tables/Step1C-create-tables.sql'],
+                                             path, path + '/Step1C-load.log')
+            run['stages']['Step1C load'] = {'seconds': seconds, 'peak_rss_mb': peak_rss_mb, 'rows': n_rows}
+        if args.duckdb:
+            seconds, peak_rss_mb = run_stage([python, step1_path + '/Step1E-Create-duckdb.py', path, 'v2p9', '--materialize'], path, path + '/Step1E.log')
+            run['stages']['Step1E'] = {'seconds': seconds, 'peak_rss_mb': peak_rss_mb, 'rows': n_rows}
+
+        print('  ' + 'stage'.ljust(26), 'seconds'.rjust(9), 'rows/sec'.rjust(10), 'MB/sec'.rjust(8), 'peak RSS MB'.rjust(12))
+        for name, stage in run['stages'].items():
+            print_stage(name, stage)
+        if args.dsn is not None or args.duckdb:
+            run_stage([python, benchmarks_path + '/bench_duckdb_vs_postgres.py', path, '--repeat', str(args.repeat), '--json', path + '/queries.json']
+                      + (['--dsn', args.dsn] if args.dsn is not None else ['--no-postgres']) + ([] if args.duckdb else ['--no-duckdb']),
+                      path, path + '/queries.log')
+            with open(path + '/queries.json') as f:
+                run['queries'] = json.load(f)
+            for backend, seconds in run['queries'].items():
+                print('  ' + ('Step2 queries, ' + backend).ljust(26), str(round(sum(seconds.values()), 3)).rjust(9))
+
+        results.append(run)
+        with open(args.results, 'w') as f:
+            json.dump(results, f, indent=1)
+    print('\nResults appended to', args.results)
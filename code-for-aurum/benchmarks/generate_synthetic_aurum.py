@@ -0,0 +1,271 @@
+# Generator of a synthetic CPRD Aurum extract, to benchmark the workflow at any scale
+# Run as: python generate_synthetic_aurum.py path-to-text-files [--patients 10000] [--workers N] [--seed 1]
+# E.g. python generate_synthetic_aurum.py /tmp/SYN_10M --patients 10000000 --workers 16
+# Writes tab-delimited txt files, shaped like a CPRD Aurum extract, for all the tables of the Step1A metadata:
+# - the patient and event tables (Patient, Consultation, Observation, DrugIssue, Problem, Referral) as numbered part files,
+#   one per block of --block-patients patients (e.g. Observation_001.txt), generated in parallel by --workers processes
+# - Practice and Staff, the Medical and Product dictionaries, Common_Dosages and the lookup tables as single files
+# The fields follow the formats of the metadata: patid ending in the 5-digit pracid, DD/MM/YYYY dates, 19-digit obsids,
+# 6-18 digit medcodeids/prodcodeids; each patient gets on average --consultations/--observations/--drug-issues/--problems/--referrals
+# rows of the event tables, all dated within their registration, with codes drawn so that a few codes are very common
+# The output is the same for the same --seed and --block-patients, whatever the number of workers
+# The data is random: it has the shape and scale of an extract, not its statistics
+
+## Libraries
+import os
+import argparse
+import datetime
+import hashlib
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+## Table layouts, with the field names of the Step1A metadata
+HEADERS = {
+    'Patient': ['patid', 'pracid', 'usualgpstaffid', 'gender', 'yob', 'mob', 'emis_ddate', 'regstartdate', 'patienttypeid', 'regenddate', 'acceptable', 'cprd_ddate'],
+    'Practice': ['pracid', 'lcd', 'uts', 'region'],
+    'Staff': ['staffid', 'pracid', 'jobcatid'],
+    'Consultation': ['patid', 'consid', 'pracid', 'consdate', 'enterdate', 'staffid', 'conssourceid', 'cprdconstype', 'consmedcodeid'],
+    'Observation': ['patid', 'consid', 'pracid', 'obsid', 'obsdate', 'enterdate', 'staffid', 'parentobsid', 'medcodeid', 'value', 'numunitid', 'obstypeid', 'numrangelow', 'numrangehigh', 'probobsid'],
+    'Problem': ['patid', 'obsid', 'pracid', 'parentprobobsid', 'probenddate', 'expduration', 'lastrevdate', 'lastrevstaffid', 'parentprobrelid', 'probstatusid', 'signid'],
+    'Referral': ['patid', 'obsid', 'pracid', 'refsourceorgid', 'reftargetorgid', 'refurgencyid', 'refservicetypeid', 'refmodeid'],
+    'DrugIssue': ['patid', 'issueid', 'pracid', 'probobsid', 'drugrecid', 'issuedate', 'enterdate', 'staffid', 'prodcodeid', 'dosageid', 'quantity', 'quantunitid', 'duration', 'estnhscost'],
+    'MedicalDictionary': ['MedCodeId', 'Term', 'OriginalReadCode', 'CleansedReadCode', 'SnomedCTConceptId', 'SnomedCTDescriptionId', 'Release', 'EmisCodeCategoryId'],
+    'ProductDictionary': ['ProdCodeId', 'dmdid', 'TermfromEMIS', 'ProductName', 'Formulation', 'RouteOfAdministration', 'DrugSubstanceName', 'SubstanceStrength', 'BNFChapter', 'Release'],
+    'Common_Dosages': ['dosageid', 'dosage_text', 'daily_dose', 'does_number', 'dose_unit', 'dose_frequency', 'dose_interval', 'choice_of_dose', 'dose_max_average', 'change_dose', 'dose_duration'],
+}
+PATIENT_TABLES = ['Patient', 'Consultation', 'Observation', 'Problem', 'Referral', 'DrugIssue'] # written per block of patients
+
+# lookup tables: (id field, number of ids or list of descriptions)
+LOOKUPS = {
+    'Gender': ('genderid', ['Male', 'Female', 'Indeterminate', 'Unknown']),
+    'Region': ('regionid', ['North East', 'North West', 'Yorkshire And The Humber', 'East Midlands', 'West Midlands', 'East of England',
+                            'London', 'South East', 'South West', 'Wales', 'Scotland', 'Northern Ireland', 'Unknown']),
+    'PatientType': ('patienttypeid', 20), 'JobCat': ('jobcatid', 50), 'ConsSource': ('conssourceid', 60), 'EMISCodeCat': ('emiscodecatid', 40),
+    'NumUnit': ('numunitid', 1000), 'ObsType': ('obstypeid', 10), 'OrgType': ('orgtypeid', 70), 'ParentProbRel': ('parentprobrelid', 5),
+    'ProbStatus': ('probstatusid', 4), 'QuantUnit': ('quantunitid', 60), 'RefMode': ('refmodeid', 8), 'RefServiceType': ('refservicetypeid', 20),
+    'RefUrgency': ('refurgencyid', 5), 'Sign': ('signid', 4),
+}
+
+# terms of the dictionaries, including those used by the Step2C examples
+CONDITIONS = ['Type 2 diabetes mellitus', 'Type 1 diabetes mellitus', 'Essential hypertension', 'Asthma', 'Chronic obstructive pulmonary disease',
+              'Atrial fibrillation', 'Hypothyroidism', 'Depressive episode', 'Osteoarthritis', 'Body mass index', 'Blood pressure', 'HbA1c level',
+              'Serum cholesterol', 'Smoker', 'Ex-smoker', 'Influenza vaccination', 'Chronic kidney disease stage 3', 'Heart failure',
+              'Migraine', 'Eczema', 'Anxiety state', 'Urinary tract infection', 'Lower back pain', 'Seen in GP surgery']
+SUBSTANCES = ['Metformin hydrochloride', 'Gliclazide', 'Sitagliptin', 'Insulin glargine', 'Amlodipine', 'Ramipril', 'Atorvastatin', 'Simvastatin',
+              'Salbutamol', 'Beclometasone dipropionate', 'Levothyroxine sodium', 'Sertraline', 'Omeprazole', 'Paracetamol', 'Amoxicillin',
+              'Bisoprolol fumarate', 'Apixaban', 'Lansoprazole', 'Co-codamol', 'Ibuprofen']
+
+FIRST_DAY = datetime.date(1940, 1, 1).toordinal()
+RELEASE_DAY = datetime.date(2021, 10, 1).toordinal() # events end at the release date of the extract
+
+## Functions
+# every date (as an ordinal) an extract can hold, in the DD/MM/YYYY format of the CPRD txt files, formatted once
+DATE_TEXT = [datetime.date.fromordinal(day).strftime('%d/%m/%Y') for day in range(FIRST_DAY, RELEASE_DAY + 1)]
+
+def ddmmyyyy(day):
+    return DATE_TEXT[day - FIRST_DAY]
+
+# random.randrange/randint/choice are slow for the number of values drawn here, these draw from random.random only
+def below(n):
+    # index in [0, n)
+    return int(random.random() * n)
+
+def pick(values):
+    return values[int(random.random() * len(values))]
+
+def skewed(n):
+    # index in [0, n), low indexes much more frequent, as codes are in real data
+    return int(n * random.random() ** 3)
+
+def n_events(mean):
+    # number of events of a patient: exponential around mean (rounded), capped at 999 (the per-patient id space, see patient_ids)
+    return min(int(random.expovariate(1 / mean) + 0.5) if mean > 0 else 0, 999)
+
+def patient_ids(i, k):
+    # the k-th id (k < 1000) of an event of patient i: 19 digits, unique within each table
+    return str(10**18 + i * 1000 + k)
+
+def pracid_of(i, patients_per_practice):
+    return 20001 + i // patients_per_practice
+
+def medcodeid(k):
+    return str(10**6 + 7919 * k)
+
+def prodcodeid(k):
+    return str(3 * 10**6 + 6113 * k)
+
+def dosageid(k):
+    return hashlib.sha256(str(k).encode()).hexdigest()
+
+def write_txt(path, header, rows):
+    # writes a tab-delimited txt file, as CPRD delivers them
+    with open(path, 'w', encoding='latin1', newline='') as txt_file:
+        txt_file.write('\t'.join(header) + '\n')
+        for row in rows:
+            txt_file.write('\t'.join(row) + '\n')
+
+def generate_block(path_to, block, first_patient, last_patient, options):
+    # writes the part files (e.g. Observation_003.txt) of patients [first_patient, last_patient)
+    # returns the number of rows written per table
+    random.seed(options['seed'] * 1000003 + block)
+    suffix = '_' + str(block + 1).zfill(3)
+    files = {table: open(path_to + '/' + table + suffix + '.txt', 'w', encoding='latin1', newline='') for table in PATIENT_TABLES}
+    n_rows = dict.fromkeys(PATIENT_TABLES, 0)
+    for table, txt_file in files.items():
+        txt_file.write('\t'.join(HEADERS[table]) + '\n')
+    medcodeids = [medcodeid(k) for k in range(options['medcodes'])]
+    prodcodeids = [prodcodeid(k) for k in range(options['prodcodes'])]
+    dosageids = [dosageid(k) for k in range(options['dosages'])]
+    for i in range(first_patient, last_patient):
+        pracid = str(pracid_of(i, options['patients_per_practice']))
+        patid = str(i + 1) + pracid
+        staff = [pracid + str(k).zfill(3) for k in range(options['staff_per_practice'])]
+
+        # registration: most patients still registered at the release date, a few died
+        yob = 1920 + below(102)
+        start = max(datetime.date(yob, 1, 1).toordinal(), FIRST_DAY) + below(365 * 30)
+        start = min(start, RELEASE_DAY - 30)
+        end = start + below(RELEASE_DAY - start) if random.random() < 0.3 else None
+        died = end is not None and random.random() < 0.3
+        last = end or RELEASE_DAY
+        files['Patient'].write('\t'.join([patid, pracid, pick(staff), str(pick([1, 1, 2, 2, 3])), str(yob),
+                                          str(1 + below(12)) if yob > 2005 else '', ddmmyyyy(end) if died else '', ddmmyyyy(start),
+                                          str(pick([3, 3, 3, 3, 1, 2])), ddmmyyyy(end) if end else '', '1' if random.random() < 0.9 else '0',
+                                          ddmmyyyy(end) if died and random.random() < 0.9 else '']) + '\n')
+        n_rows['Patient'] += 1
+
+        def event_day():
+            return start + below(last - start + 1)
+
+        rows = []
+        consultations = [patient_ids(i, k) for k in range(n_events(options['consultations']))]
+        for consid in consultations:
+            day = event_day()
+            rows.append('\t'.join([patid, consid, pracid, ddmmyyyy(day), ddmmyyyy(min(day + below(3), RELEASE_DAY)), pick(staff),
+                                   str(1 + below(60)), str(1 + below(60)), medcodeids[skewed(len(medcodeids))]]) + '\n')
+        files['Consultation'].writelines(rows)
+        n_rows['Consultation'] += len(rows)
+
+        rows = []
+        obsids = []
+        problems = []
+        for k in range(n_events(options['observations'])):
+            obsid = patient_ids(i, k)
+            day = event_day()
+            measured = random.random() < 0.2
+            value = round(random.gauss(50, 20), 3) if measured else None
+            parentobsid = pick(obsids) if obsids and random.random() < 0.05 else ''
+            probobsid = pick(problems) if problems and random.random() < 0.1 else ''
+            if len(problems) < options['problems'] * 3 and random.random() < options['problems'] / max(options['observations'], 1):
+                problems.append(obsid)
+            rows.append('\t'.join([patid, pick(consultations) if consultations and random.random() < 0.9 else '', pracid, obsid,
+                                   ddmmyyyy(day) if random.random() < 0.97 else '', ddmmyyyy(min(day + below(5), RELEASE_DAY)),
+                                   pick(staff), parentobsid, medcodeids[skewed(len(medcodeids))], str(value) if measured else '',
+                                   str(1 + below(1000)) if measured else '', str(1 + below(10)),
+                                   str(round(value - 20, 3)) if measured else '', str(round(value + 20, 3)) if measured else '', probobsid]) + '\n')
+            obsids.append(obsid)
+        files['Observation'].writelines(rows)
+        n_rows['Observation'] += len(rows)
+
+        rows = []
+        for obsid in problems:
+            review = event_day()
+            rows.append('\t'.join([patid, obsid, pracid, pick(problems) if random.random() < 0.1 else '',
+                                   ddmmyyyy(review) if random.random() < 0.3 else '', str(below(366)) if random.random() < 0.2 else '',
+                                   ddmmyyyy(review), pick(staff), str(1 + below(5)) if random.random() < 0.1 else '',
+                                   str(1 + below(4)), str(1 + below(4))]) + '\n')
+        files['Problem'].writelines(rows)
+        n_rows['Problem'] += len(rows)
+
+        rows = []
+        referred = sorted(set(pick(obsids) for _ in range(n_events(options['referrals'])))) if obsids else [] # obsid is the key of Referral
+        for obsid in referred:
+            rows.append('\t'.join([patid, obsid, pracid, str(1 + below(10**6)), str(1 + below(10**6)),
+                                   str(1 + below(5)), str(1 + below(20)), str(1 + below(8))]) + '\n')
+        files['Referral'].writelines(rows)
+        n_rows['Referral'] += len(rows)
+
+        rows = []
+        for k in range(n_events(options['drug_issues'])):
+            day = event_day()
+            quantity = pick([28, 28, 56, 84, 100, 1])
+            rows.append('\t'.join([patid, patient_ids(i, k), pracid, pick(problems) if problems and random.random() < 0.2 else '',
+                                   str(10**17 + i * 100 + k % 100), ddmmyyyy(day), ddmmyyyy(min(day + below(2), RELEASE_DAY)),
+                                   pick(staff), prodcodeids[skewed(len(prodcodeids))], dosageids[skewed(len(dosageids))],
+                                   str(quantity) + '.000', str(1 + below(60)), str(quantity), str(round(random.uniform(0.5, 50), 4))]) + '\n')
+        files['DrugIssue'].writelines(rows)
+        n_rows['DrugIssue'] += len(rows)
+    for txt_file in files.values():
+        txt_file.close()
+    return n_rows
+
+def generate_reference_tables(path_to, n_practices, options):
+    # writes Practice, Staff, the dictionaries, Common_Dosages and the lookup tables
+    # returns the number of rows written per table
+    random.seed(options['seed'])
+    n_rows = {}
+    def write(table, header, rows):
+        rows = list(rows)
+        write_txt(path_to + '/' + table + '.txt', header, rows)
+        n_rows[table] = len(rows)
+
+    write('Practice', HEADERS['Practice'], ([str(20001 + p), ddmmyyyy(RELEASE_DAY - random.randrange(400)), '', str(random.randint(1, 13))]
+                                           for p in range(n_practices)))
+    write('Staff', HEADERS['Staff'], ([str(20001 + p) + str(k).zfill(3), str(20001 + p), str(random.randint(1, 50))]
+                                      for p in range(n_practices) for k in range(options['staff_per_practice'])))
+    write('MedicalDictionary', HEADERS['MedicalDictionary'],
+          ([medcodeid(k), CONDITIONS[k % len(CONDITIONS)] + ('' if k < len(CONDITIONS) else ' ' + str(k // len(CONDITIONS))), 'C10' + str(k % 100).zfill(2),
+            'C10' + str(k % 100).zfill(2), str(44054006 + k), str(10**14 + k), '', str(random.randint(1, 40))] for k in range(options['medcodes'])))
+    write('ProductDictionary', HEADERS['ProductDictionary'],
+          ([prodcodeid(k), str(10**16 + k), SUBSTANCES[k % len(SUBSTANCES)] + ' ' + str(k // len(SUBSTANCES) + 1) + 'mg tablets',
+            SUBSTANCES[k % len(SUBSTANCES)] + ' ' + str(k // len(SUBSTANCES) + 1) + 'mg tablets', 'Tablet', 'Oral', SUBSTANCES[k % len(SUBSTANCES)],
+            str(k // len(SUBSTANCES) + 1) + 'mg', str(random.randint(1, 15)), ''] for k in range(options['prodcodes'])))
+    write('Common_Dosages', HEADERS['Common_Dosages'],
+          ([dosageid(k), 'TAKE ' + str(k % 4 + 1) + ' DAILY', str(k % 4 + 1), str(k % 4 + 1), 'TABLET', str(k % 4 + 1), '1', '0', '0', '0', '0']
+           for k in range(options['dosages'])))
+    for table, (id_field, descriptions) in LOOKUPS.items():
+        if isinstance(descriptions, int):
+            descriptions = [table + ' ' + str(k + 1) for k in range(descriptions)]
+        write(table, [id_field, 'Description'], ([str(k + 1), description] for k, description in enumerate(descriptions)))
+    return n_rows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate a synthetic CPRD Aurum extract of txt files')
+    parser.add_argument('path_to', help='directory to write the txt files to')
+    parser.add_argument('--patients', type=int, default=10000, help='number of patients (default: 10000)')
+    parser.add_argument('--patients-per-practice', type=int, default=10000, help='(default: 10000)')
+    parser.add_argument('--staff-per-practice', type=int, default=50, help='(default: 50)')
+    parser.add_argument('--consultations', type=float, default=40, help='average number of consultations per patient (default: 40)')
+    parser.add_argument('--observations', type=float, default=100, help='average number of observations per patient (default: 100)')
+    parser.add_argument('--drug-issues', type=float, default=60, help='average number of drug issues per patient (default: 60)')
+    parser.add_argument('--problems', type=float, default=3, help='average number of problems per patient (default: 3)')
+    parser.add_argument('--referrals', type=float, default=1, help='average number of referrals per patient (default: 1)')
+    parser.add_argument('--medcodes', type=int, default=100000, help='number of codes in the medical dictionary (default: 100000)')
+    parser.add_argument('--prodcodes', type=int, default=50000, help='number of codes in the product dictionary (default: 50000)')
+    parser.add_argument('--dosages', type=int, default=10000, help='number of common dosages (default: 10000)')
+    parser.add_argument('--block-patients', type=int, default=100000, help='number of patients per part file (default: 100000)')
+    parser.add_argument('--workers', type=int, default=1, help='number of processes generating part files concurrently (default: 1)')
+    parser.add_argument('--seed', type=int, default=1, help='random seed (default: 1)')
+    args = parser.parse_args()
+
+    options = {'seed': args.seed, 'patients_per_practice': args.patients_per_practice, 'staff_per_practice': args.staff_per_practice,
+               'consultations': args.consultations, 'observations': args.observations, 'drug_issues': args.drug_issues,
+               'problems': args.problems, 'referrals': args.referrals, 'medcodes': args.medcodes, 'prodcodes': args.prodcodes, 'dosages': args.dosages}
+    os.makedirs(args.path_to, exist_ok=True)
+    started = time.perf_counter()
+    n_practices = (args.patients - 1) // args.patients_per_practice + 1
+    n_rows = generate_reference_tables(args.path_to, n_practices, options)
+
+    blocks = [(args.path_to, block, first, min(first + args.block_patients, args.patients), options)
+              for block, first in enumerate(range(0, args.patients, args.block_patients))]
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        for block_rows in pool.map(generate_block, *zip(*blocks)):
+            for table, rows in block_rows.items():
+                n_rows[table] = n_rows.get(table, 0) + rows
+
+    for table, rows in sorted(n_rows.items()):
+        print(table.ljust(20), str(rows).rjust(12))
+    elapsed = time.perf_counter() - started
+    print('All tables'.ljust(20), str(sum(n_rows.values())).rjust(12), '| seconds:', round(elapsed, 2), '| rows/sec:', round(sum(n_rows.values()) / elapsed))